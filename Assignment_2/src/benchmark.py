@@ -0,0 +1,169 @@
+from dataset import *
+import heapq
+import time
+import tracemalloc
+
+
+def trace_contours_reference(thinned):
+    # The original list-scan tracer. Every step compares the neighbours against the whole current contour and every
+    # restart compares the black pixels against every completed contour, so it is quadratic to cubic in the number of
+    # skeleton pixels. benchmark_contour checks that trace_contours finds the same contours.
+    # - thinned: skeleton image where the skeleton pixels are black (0)
+    # - c: list with one element for each contour of the letter; each element is a list of [row, column] points
+
+    # Find the coordinates of all black pixels
+    black_pixels = np.argwhere(thinned == 0)
+
+    # Initialize variables for tracking current contour
+    current_contour = []
+    c = []
+    filler = []
+
+    # Start at top left corner
+    current_pixel = black_pixels[0]
+
+    # Add first pixel to outer contour
+    current_contour.append(list(current_pixel))
+
+    count = 0
+
+    # Loop until we've come back to starting point
+    while True:
+
+        # Define search area around current pixel
+        min_row = max(0, current_pixel[0] - 1)
+        max_row = min(thinned.shape[0] - 1, current_pixel[0] + 1)
+        min_col = max(0, current_pixel[1] - 1)
+        max_col = min(thinned.shape[1] - 1, current_pixel[1] + 1)
+
+        # Find all neighboring black pixels in search area
+        neighbors = [list((i, j)) for i in range(min_row, max_row + 1) for j in range(min_col, max_col + 1)
+                     if thinned[i, j] == 0 and list((i, j)) not in current_contour]
+
+        if not neighbors:
+            count += 1
+            if count == 4:
+                smallest_elements = heapq.nsmallest(2, c, key=len)
+                c = [item for item in c if item not in smallest_elements]
+                break
+            if len(current_contour) > 10:
+                c.append(current_contour.copy())
+                filler.append(current_contour.copy())
+            else:
+                filler.append(current_contour.copy())
+
+            current_pixel = None
+            for pixel in black_pixels:
+                if not any(list(pixel) in sublist for sublist in filler):
+                    current_pixel = list(pixel)
+                    current_contour.clear()
+                    current_contour.append(current_pixel)
+                    break
+            if current_pixel:
+                continue
+            break
+
+        next_pixel = min(neighbors, key=lambda p: (p[0], -p[1]))
+        current_pixel = next_pixel
+        current_contour.append(list(current_pixel))
+
+    return c
+
+
+def benchmark_contour(images):
+    # Compares the time trace_contours and trace_contours_reference need to trace every letter of the given text images
+    # and checks that both find the same contours for every letter.
+    # - images: list of the paths of the text images
+
+    for path in images:
+        img = cv2.imread(path)
+        img_dataset, _, _ = segment_letters(img, 17, 7)
+        skeletons = [get_skeleton(clean_letter(letter)) for line in img_dataset for word in line for letter in word]
+
+        start_time = time.time()
+        contours = [trace_contours(thinned) for thinned in skeletons]
+        engine_time = time.time() - start_time
+
+        start_time = time.time()
+        reference_contours = [trace_contours_reference(thinned) for thinned in skeletons]
+        reference_time = time.time() - start_time
+
+        for c, reference_c in zip(contours, reference_contours):
+            assert len(c) == len(reference_c)
+            assert [np.array(contour).tolist() for contour in c] == \
+                   [np.array(contour).tolist() for contour in reference_c]
+
+        print(path, ":", len(skeletons), "letters,", sum(len(contour) for c in contours for contour in c),
+              "contour pixels")
+        print("trace_contours:", engine_time, "seconds")
+        print("trace_contours_reference:", reference_time, "seconds")
+
+
+def benchmark_rotation(images, tolerance=0.1):
+    # Compares the angle and the time of the exhaustive sweep and the coarse-to-fine refinement of find_rotation_angle.
+    # - images: list of the paths of the text images
+    # - tolerance: the maximum difference in degrees allowed between the two angles
+
+    for path in images:
+        img = cv2.imread(path)
+
+        start_time = time.time()
+        sweep_angle = find_rotation_angle(img, "sweep")
+        sweep_time = time.time() - start_time
+
+        start_time = time.time()
+        coarse_to_fine_angle = find_rotation_angle(img, "coarse_to_fine")
+        coarse_to_fine_time = time.time() - start_time
+
+        print(path, ":", img.shape)
+        print("sweep:", sweep_angle, "degrees,", sweep_time, "seconds")
+        print("coarse_to_fine:", coarse_to_fine_angle, "degrees,", coarse_to_fine_time, "seconds")
+        assert abs(sweep_angle - coarse_to_fine_angle) < tolerance
+
+
+def benchmark_rotation_scorer(images, tolerance=0.01):
+    # Compares projection_gradient_scores with projection_gradient_score, which rotates the image for every angle, on
+    # the angles from -2 to 2 degrees every 0.05 degrees: the time, the peak memory each one allocates, as traced by
+    # tracemalloc, and the scores.
+    # - images: list of the paths of the text images
+    # - tolerance: the maximum relative difference allowed between the scores
+
+    for path in images:
+        grayscale = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+        angles = np.arange(-2, 2, 0.05)
+
+        tracemalloc.start()
+        start_time = time.time()
+        scores = np.array([projection_gradient_score(grayscale, angle) for angle in angles])
+        warp_time = time.time() - start_time
+        warp_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        start_time = time.time()
+        ink_scores = projection_gradient_scores(grayscale, angles)
+        ink_time = time.time() - start_time
+        ink_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(path, ":", len(angles), "angles")
+        print("projection_gradient_score:", warp_time, "seconds,", warp_memory / 2 ** 20, "MB, best angle",
+              angles[np.argmax(scores)])
+        print("projection_gradient_scores:", ink_time, "seconds,", ink_memory / 2 ** 20, "MB, best angle",
+              angles[np.argmax(ink_scores)])
+        print("maximum relative difference:", np.max(np.abs(ink_scores - scores) / scores))
+        assert np.all(np.abs(ink_scores - scores) <= tolerance * scores)
+
+
+if __name__ == "__main__":
+    benchmarks = {
+        "contour": lambda: benchmark_contour(["text1.png", "text2.png"]),
+        "rotation": lambda: benchmark_rotation(["text1_rot.png", "text2_rot.png"]),
+        "rotation_scorer": lambda: benchmark_rotation_scorer(["text1_rot.png", "text2_rot.png", "text1_v3.png"]),
+    }
+
+    for name in sys.argv[1:] or benchmarks:
+        print("--------------------")
+        print(name)
+        print("--------------------")
+        benchmarks[name]()
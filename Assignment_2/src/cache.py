@@ -0,0 +1,176 @@
+import hashlib
+import inspect
+import instrumentation
+import os
+import tempfile
+import rotation
+import contour
+import descriptor
+import dataset
+from dataset import *
+
+# Bump CACHE_FORMAT when the layout of the cache files changes. The preprocessing version is the hash of the source of
+# the modules that turn an image into contours and descriptors, so every change to that code invalidates the cache.
+CACHE_FORMAT = 1
+PREPROCESSING_VERSION = hashlib.sha256(
+    "".join(inspect.getsource(module) for module in (rotation, contour, descriptor, dataset)).encode()
+).hexdigest()[:16]
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024  # bytes
+
+
+def get_cached_dataset(img, text, blur, resize, N, cache_dir=None, max_size=DEFAULT_CACHE_SIZE, workers=1):
+    # Works like get_dataset but keeps the contours and the descriptors of every letter of the image in an on-disk
+    # cache. The cache entries are .npz files keyed by the hash of the image bytes, the segmentation parameters and
+    # the version of the preprocessing code, so a repeated run on the same image skips the rotation search, the
+    # segmentation and the contour tracing. When the size of the cache grows over max_size the least recently used
+    # entries are removed.
+    # - img: the text image from which we want to extract the img_dataset
+    # - text: the text document from which we want to extract the ascii_dataset
+    # - blur, resize: the segmentation parameters of segment_letters
+    # - N: the number of points every contour is resampled to
+    # - cache_dir: the directory of the cache, the cache is not used if it is None
+    # - max_size: the maximum size of the cache in bytes
+    # - workers: the number of worker processes of get_img_dataset
+    # - img_dataset: a list containing the contour of each letter of the dataset
+    # - ascii_dataset: a list containing each letter of the dataset in ascii code
+    # - descriptors: (number of contours, N - 1) matrix with the descriptor of every contour in the order of img_dataset
+
+    ascii_dataset = get_ascii_dataset(text)
+
+    if cache_dir is None:
+        img_dataset = get_img_dataset(img, blur, resize, workers)
+        descriptors = get_descriptors(flatten_contours(img_dataset), N)
+        return img_dataset, ascii_dataset, descriptors
+
+    path = os.path.join(cache_dir, get_cache_key(img, blur, resize, N) + ".npz")
+
+    if os.path.exists(path):
+        img_dataset, descriptors = load_cache_entry(path)
+        os.utime(path)  # mark the entry as recently used
+        print("Dataset loaded from cache: ", path)
+        instrumentation.count("cache_hits")
+    else:
+        img_dataset = get_img_dataset(img, blur, resize, workers)
+        descriptors = get_descriptors(flatten_contours(img_dataset), N)
+        save_cache_entry(path, img_dataset, descriptors)
+        evict_cache(cache_dir, max_size, keep=os.path.basename(path))
+        instrumentation.count("cache_misses")
+
+    return img_dataset, ascii_dataset, descriptors
+
+
+def get_cache_key(img, blur, resize, N):
+    # Hashes the bytes of the image together with the parameters that affect the contours and the descriptors.
+    # - img: the text image
+    # - blur, resize, N: the segmentation and descriptor parameters
+    # - key: the hexadecimal digest that names the cache entry
+
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(img).tobytes())
+    h.update(repr((img.shape, str(img.dtype), blur, resize, N, CACHE_FORMAT, PREPROCESSING_VERSION)).encode())
+
+    return h.hexdigest()
+
+
+def flatten_contours(img_dataset):
+    # Lists the contours of every letter of img_dataset in line, word, letter order.
+    # - img_dataset: a list containing the contour of each letter of the dataset
+    # - contours: a flat list of contours
+
+    return [c for line in img_dataset for word in line for letter in word for c in letter]
+
+
+def save_cache_entry(path, img_dataset, descriptors):
+    # Stores img_dataset and the descriptors in an .npz file. The nested lists are stored as flat arrays of points and
+    # the sizes of every line, word, letter and contour. The file is written under a temporary name and then renamed,
+    # so a reader never sees a half written entry.
+    # - path: the path of the cache entry
+    # - img_dataset: a list containing the contour of each letter of the dataset
+    # - descriptors: the descriptor of every contour in the order of img_dataset
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    contours = flatten_contours(img_dataset)
+    if len(contours) > 0:
+        points = np.concatenate([np.asarray(c, dtype=np.int16).reshape(-1, 2) for c in contours])
+    else:
+        points = np.empty((0, 2), dtype=np.int16)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f,
+                 points=points,
+                 contour_sizes=np.array([len(c) for c in contours], dtype=np.int32),
+                 letter_sizes=np.array([len(letter) for line in img_dataset for word in line for letter in word],
+                                       dtype=np.int32),
+                 word_sizes=np.array([len(word) for line in img_dataset for word in line], dtype=np.int32),
+                 line_sizes=np.array([len(line) for line in img_dataset], dtype=np.int32),
+                 descriptors=descriptors)
+    os.replace(tmp_path, path)
+
+
+def load_cache_entry(path):
+    # Reads an entry written by save_cache_entry and rebuilds the nested lists of img_dataset.
+    # - path: the path of the cache entry
+    # - img_dataset: a list containing the contour of each letter of the dataset
+    # - descriptors: the descriptor of every contour in the order of img_dataset
+
+    with np.load(path) as entry:
+        points = entry["points"].tolist()
+        contour_sizes = entry["contour_sizes"].tolist()
+        letter_sizes = entry["letter_sizes"].tolist()
+        word_sizes = entry["word_sizes"].tolist()
+        line_sizes = entry["line_sizes"].tolist()
+        descriptors = entry["descriptors"]
+
+    contours = []
+    start = 0
+    for size in contour_sizes:
+        contours.append(points[start:start + size])
+        start += size
+
+    letters = []
+    start = 0
+    for size in letter_sizes:
+        letters.append(contours[start:start + size])
+        start += size
+
+    words = []
+    start = 0
+    for size in word_sizes:
+        words.append(letters[start:start + size])
+        start += size
+
+    img_dataset = []
+    start = 0
+    for size in line_sizes:
+        img_dataset.append(words[start:start + size])
+        start += size
+
+    return img_dataset, descriptors
+
+
+def evict_cache(cache_dir, max_size, keep=None):
+    # Removes the least recently used entries of the cache until its total size is at most max_size bytes. The entry
+    # keep is never removed, even if it alone is larger than max_size.
+    # - cache_dir: the directory of the cache
+    # - max_size: the maximum size of the cache in bytes
+    # - keep: the file name of an entry that must stay, usually the one that was just written
+
+    entries = []
+    kept_size = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npz"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            if name == keep:
+                kept_size = stat.st_size
+            else:
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+    total_size = kept_size + sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total_size -= size
@@ -6,6 +6,10 @@ import skimage
 
 np.set_printoptions(threshold=sys.maxsize)
 
+# Offsets of the 8 neighbours of a pixel in the order the tracer prefers them: the upper row first and, inside each
+# row, from right to left. This is the order of min(neighbors, key=lambda p: (p[0], -p[1])) of the original tracer.
+NEIGHBOUR_OFFSETS = ((-1, 1), (-1, 0), (-1, -1), (0, 1), (0, -1), (1, 1), (1, 0), (1, -1))
+
 
 def get_contour(x):
     # Finds the contour (one or more) of a letter by taking the dilated image and subtracting from the original. Then
@@ -14,6 +18,39 @@ def get_contour(x):
     # - c: cell array with one cell for each contour of the letter; each cell contains an N x 2 matrix, where N is
     # the number of points that describe the contour and each row has the two coordinates of each point
 
+    thinned = get_skeleton(x)
+
+    c = trace_contours(thinned)
+
+    # # Create binary image with only the pixels indicated by the outer and inner contours
+    # binary_contours = np.zeros_like(thinned) + 255
+    # for pixel in c[0]:
+    #     binary_contours[pixel[0], pixel[1]] = 0
+    # if len(c) > 1:
+    #     for pixel in c[1]:
+    #         binary_contours[pixel[0], pixel[1]] = 200
+    # if len(c) > 2:
+    #     for pixel in c[2]:
+    #         binary_contours[pixel[0], pixel[1]] = 150
+    #
+    # binary_contours = binary_contours.astype(np.uint8)
+    #
+    # # Show the binary image with only the pixels indicated by the contour
+    # cv2.namedWindow('Contours', cv2.WINDOW_NORMAL)
+    # cv2.imshow('Contours', binary_contours)
+    # cv2.waitKey(0)
+    # cv2.destroyAllWindows()
+
+    return c
+
+
+def get_skeleton(x):
+    # Resizes and normalizes the letter, subtracts it from its dilation to keep only the borders and thins the borders
+    # down to a one pixel wide skeleton.
+    # - x: input image containing one letter
+    # - thinned: image of the same size as the resized letter where the skeleton pixels are black (0) and the rest
+    # are white (255)
+
     # Resize and normalize the image
     max_width = 110
     max_height = 110
@@ -47,80 +84,82 @@ def get_contour(x):
     # cv2.namedWindow('img', cv2.WINDOW_NORMAL)
     # cv2.imshow("img", thinned)
     # cv2.waitKey(0)
+    # cv2.destroyAllWindows()
+
+    return thinned
+
+
+def trace_contours(thinned):
+    # Walks the skeleton of a letter and splits it into contours. Starting from the top left black pixel it always
+    # moves to the upper-right-most black neighbour that is not already part of the current contour. When it reaches a
+    # dead end the contour is stored and the walk restarts from the first black pixel that no contour has visited yet.
+    # Membership is kept in boolean masks and the neighbours are visited through a fixed offset table, so every pixel
+    # is handled a constant number of times and the tracing is linear in the size of the image.
+    # - thinned: skeleton image where the skeleton pixels are black (0)
+    # - c: list with one element for each contour of the letter; each element is a list of [row, column] points
 
     # Find the coordinates of all black pixels
     black_pixels = np.argwhere(thinned == 0)
+    if len(black_pixels) == 0:
+        return []
+
+    # Pad the masks by one pixel so that the neighbours of the border pixels never fall outside of the image
+    height, width = thinned.shape[:2]
+    black = np.zeros((height + 2, width + 2), dtype=bool)
+    black[1:-1, 1:-1] = thinned == 0
+    in_contour = np.zeros_like(black)  # pixels of the contour that is currently traced
+    visited = np.zeros_like(black)  # pixels of every contour that has been completed
+
+    # Convert to Python lists once, scalar access on lists is much cheaper than on numpy arrays
+    black = black.tolist()
+    in_contour = in_contour.tolist()
+    visited = visited.tolist()
 
     # Initialize variables for tracking current contour
-    current_contour = []
     c = []
-    filler = []
+    count = 0
+    start_index = 0
 
     # Start at top left corner
-    current_pixel = black_pixels[0]
-
-    # Add first pixel to outer contour
-    current_contour.append(list(current_pixel))
+    row, col = int(black_pixels[0][0]) + 1, int(black_pixels[0][1]) + 1
+    current_contour = [[row, col]]
+    in_contour[row][col] = True
 
-    count = 0
-
-    # Loop until we've come back to starting point
+    # Loop until every black pixel has been visited
     while True:
 
-        # Define search area around current pixel
-        min_row = max(0, current_pixel[0] - 1)
-        max_row = min(thinned.shape[0] - 1, current_pixel[0] + 1)
-        min_col = max(0, current_pixel[1] - 1)
-        max_col = min(thinned.shape[1] - 1, current_pixel[1] + 1)
-
-        # Find all neighboring black pixels in search area
-        neighbors = [list((i, j)) for i in range(min_row, max_row + 1) for j in range(min_col, max_col + 1)
-                     if thinned[i, j] == 0 and list((i, j)) not in current_contour]
-
-        if not neighbors:
+        # Move to the first free neighbour in the order of the offset table
+        for d_row, d_col in NEIGHBOUR_OFFSETS:
+            if black[row + d_row][col + d_col] and not in_contour[row + d_row][col + d_col]:
+                row += d_row
+                col += d_col
+                break
+        else:
             count += 1
             if count == 4:
-                smallest_elements = heapq.nsmallest(2, c, key=len)
-                c = [item for item in c if item not in smallest_elements]
+                smallest_elements = heapq.nsmallest(2, range(len(c)), key=lambda k: len(c[k]))
+                c = [item for k, item in enumerate(c) if k not in smallest_elements]
                 break
             if len(current_contour) > 10:
-                c.append(current_contour.copy())
-                filler.append(current_contour.copy())
-            else:
-                filler.append(current_contour.copy())
-
-            current_pixel = None
-            for pixel in black_pixels:
-                if not any(list(pixel) in sublist for sublist in filler):
-                    current_pixel = list(pixel)
-                    current_contour.clear()
-                    current_contour.append(current_pixel)
-                    break
-            if current_pixel:
-                continue
-            break
-
-        next_pixel = min(neighbors, key=lambda p: (p[0], -p[1]))
-        current_pixel = next_pixel
-        current_contour.append(list(current_pixel))
+                c.append([[r - 1, q - 1] for r, q in current_contour])
 
-    # # Create binary image with only the pixels indicated by the outer and inner contours
-    # binary_contours = np.zeros_like(thinned) + 255
-    # for pixel in c[0]:
-    #     binary_contours[pixel[0], pixel[1]] = 0
-    # if len(c) > 1:
-    #     for pixel in c[1]:
-    #         binary_contours[pixel[0], pixel[1]] = 200
-    # if len(c) > 2:
-    #     for pixel in c[2]:
-    #         binary_contours[pixel[0], pixel[1]] = 150
-    #
-    # binary_contours = binary_contours.astype(np.uint8)
-    #
-    # # Show the binary image with only the pixels indicated by the contour
-    # cv2.namedWindow('Contours', cv2.WINDOW_NORMAL)
-    # cv2.imshow('Contours', binary_contours)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
+            for r, q in current_contour:
+                in_contour[r][q] = False
+                visited[r][q] = True
+
+            # The visited pixels only grow, so the search for the next starting pixel never has to go back
+            while start_index < len(black_pixels) and \
+                    visited[black_pixels[start_index][0] + 1][black_pixels[start_index][1] + 1]:
+                start_index += 1
+            if start_index == len(black_pixels):
+                break
+
+            row, col = int(black_pixels[start_index][0]) + 1, int(black_pixels[start_index][1]) + 1
+            current_contour = [[row, col]]
+            in_contour[row][col] = True
+            continue
+
+        in_contour[row][col] = True
+        current_contour.append([row, col])
 
     return c
@@ -1,6 +1,9 @@
 from rotation import *
 from contour import *
 from descriptor import *
+import instrumentation
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import pandas as pd
 import codecs
 
@@ -15,6 +18,140 @@ def get_dataset(img, text, blur, resize):
     # - img_dataset: a list containing the contour of each letter of the dataset
     # - ascii_dataset: a list containing each letter of the dataset in ascii code
 
+    img_dataset = get_img_dataset(img, blur, resize)
+    ascii_dataset = get_ascii_dataset(text)
+
+    print(ascii_dataset)
+    print(sum(len(elem) for sublist in ascii_dataset for elem in sublist for elem in elem))
+    print(sum(len(elem) for sublist in img_dataset for elem in sublist))
+
+    print(ascii_dataset[4][5][1])
+
+    return img_dataset, ascii_dataset
+
+
+def get_img_dataset(img, blur, resize, workers=1, chunk_size=64):
+    # Divides the text image into its letters and calculates the contours of every letter. The letters are independent
+    # of each other, so with more than one worker they are processed by a process pool. The letters are parts of the
+    # same page image, which is copied once into shared memory; each work unit only sends the bounds of chunk_size
+    # letters to a worker and the contours come back in the order of the letters.
+    # - img: the text image from which we want to extract the img_dataset
+    # - blur, resize: the segmentation parameters of segment_letters
+    # - workers: the number of worker processes, the letters are processed serially if it is 1
+    # - chunk_size: the number of letters of each work unit
+    # - img_dataset: a list containing the contour of each letter of the dataset
+
+    img_dataset, page, letter_bounds = segment_letters(img, blur, resize)
+    bounds = [b for line in letter_bounds for word in line for b in word]
+
+    contours = trace_letters(page, bounds, workers, chunk_size)
+    instrumentation.count("letters", len(bounds))
+    if instrumentation.is_enabled():
+        instrumentation.count("contour_pixels", sum(len(c) for letter in contours for c in letter))
+
+    # Put the contours back in the place of their letters
+    index = 0
+    for line in img_dataset:
+        for word in line:
+            for i in range(len(word)):
+                word[i] = contours[index]
+                index += 1
+
+    return img_dataset
+
+
+@instrumentation.timed("contours")
+def trace_letters(page, bounds, workers=1, chunk_size=64):
+    # Calculates the contours of every letter, serially or in a process pool, see get_img_dataset.
+    # - page: the inverted page image as returned by segment_letters
+    # - bounds: list of (row, column, height, width) of each letter inside the page
+    # - workers: the number of worker processes, the letters are processed serially if it is 1
+    # - chunk_size: the number of letters of each work unit
+    # - contours: list with the contours of each letter
+
+    if workers <= 1 or len(bounds) == 0:
+        contours = [get_contour(clean_letter(page[row:row + height, col:col + width]))
+                    for row, col, height, width in bounds]
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=max(page.nbytes, 1))
+        try:
+            shared_page = np.ndarray(page.shape, dtype=page.dtype, buffer=shm.buf)
+            shared_page[:] = page
+
+            chunks = [bounds[i:i + chunk_size] for i in range(0, len(bounds), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(get_letter_contours, [shm.name] * len(chunks), [page.shape] * len(chunks),
+                                       [page.dtype.str] * len(chunks), chunks)
+                contours = [c for chunk_contours in results for c in chunk_contours]
+            del shared_page
+        finally:
+            shm.close()
+            shm.unlink()
+
+    return contours
+
+
+def get_letter_contours(shm_name, shape, dtype, bounds):
+    # Work unit of trace_letters. Attaches to the page in shared memory and calculates the contours of the letters
+    # with the given bounds.
+    # - shm_name: the name of the shared memory block of the page
+    # - shape, dtype: the shape and the data type of the page
+    # - bounds: list of (row, column, height, width) of each letter inside the page
+    # - contours: list with the contours of each letter
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        page = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        contours = [get_contour(clean_letter(page[row:row + height, col:col + width]))
+                    for row, col, height, width in bounds]
+        del page
+    finally:
+        shm.close()
+
+    return contours
+
+
+def get_ascii_dataset(text):
+    # Reads the text document of an image and splits it into lines, words and letters.
+    # - text: the text document from which we want to extract the ascii_dataset
+    # - ascii_dataset: a list containing each letter of the dataset in ascii code
+
+    # Try reading as UTF-8 first
+    try:
+        with codecs.open(text, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    # If that fails, try reading as UTF-16
+    except UnicodeDecodeError:
+        with codecs.open(text, encoding='utf-16') as f:
+            lines = f.read().splitlines()
+
+    ascii_dataset = []
+
+    for line in lines:
+        words = line.split(' ')
+        word_list = []
+        for word in words:
+            if len(word) > 0:
+                char_list = [str(char) for char in word]
+                word_list.append(char_list)
+        if len(word_list) > 0:
+            ascii_dataset.append(word_list)
+
+    return ascii_dataset
+
+
+@instrumentation.timed("segmentation")
+def segment_letters(img, blur, resize):
+    # Divides the text image into its letters. First reverses the image rotation and then separates each line, word and
+    # letter by taking the projection of brightness in the vertical and horizontal axis respectively.
+    # - img: the text image we want to divide into letters
+    # - blur: size of the blur that attaches the letters of each word with each other
+    # - resize: factor the image is scaled by before the segmentation
+    # - img_dataset: a list of lines, each line a list of words and each word a list of the (inverted) letter images
+    # - inverted: the inverted page image, every letter image is a part of it
+    # - letter_bounds: a list with the same structure as img_dataset with the (row, column, height, width) of each
+    #   letter inside the inverted page
+
     # Find the rotation angle of the image
     rotation_angle = find_rotation_angle(img)
     print("Image rotation: ", rotation_angle, "degrees")
@@ -42,6 +179,7 @@ def get_dataset(img, text, blur, resize):
 
     # Split the image into lines
     lines = []
+    line_rows = []
     offset_up = int(inverted.shape[0] / 250)
     offset_down = 0  # int(inverted.shape[0] / 100)
     for i in range(0, len(line_indices)):
@@ -52,8 +190,10 @@ def get_dataset(img, text, blur, resize):
         y2 = line_indices[i]
         line = inverted[y1-offset_up:y2-offset_down, :]
         lines.append(line)
+        line_rows.append(y1 - offset_up)
     end_line = line_indices[len(line_indices)-1]
     lines.append(inverted[end_line - offset_up:end_line + int(inverted.shape[0] / 30), :])
+    line_rows.append(end_line - offset_up)
 
     # for line in lines:
     #     cv2.namedWindow('line', cv2.WINDOW_NORMAL)
@@ -63,6 +203,7 @@ def get_dataset(img, text, blur, resize):
 
     # Initialize the dataset array
     words = []
+    word_cols = []
 
     for line in lines:
 
@@ -75,6 +216,7 @@ def get_dataset(img, text, blur, resize):
         word_indices = np.where(np.diff((horizontal_proj > 0).astype(int)) == -1)[0] + 1
 
         line_words = []
+        line_word_cols = []
         offset_left = 0
         offset_right = 0  # int(inverted.shape[1] / 300)
         for i in range(0, len(word_indices)):
@@ -85,8 +227,10 @@ def get_dataset(img, text, blur, resize):
             y2 = word_indices[i]
             word = line[:, y1 - offset_left:y2 + offset_right]
             line_words.append(word)
+            line_word_cols.append(y1 - offset_left)
 
         words.append(line_words)
+        word_cols.append(line_word_cols)
 
     # for line in words:
     #     for word in line:
@@ -96,12 +240,14 @@ def get_dataset(img, text, blur, resize):
     #         cv2.destroyAllWindows()
 
     img_dataset = []
+    letter_bounds = []
 
-    for line in words:
+    for line, line_row, line_word_cols in zip(words, line_rows, word_cols):
 
         line_letters = []
+        line_bounds = []
 
-        for word in line:
+        for word, word_col in zip(line, line_word_cols):
 
             # Remove pale pixels on the edges of the letters so that the letters do not overlap
             word[word < 135] = 0
@@ -113,6 +259,7 @@ def get_dataset(img, text, blur, resize):
             letter_indices = np.where(np.diff((horizontal_proj > 0).astype(int)) == -1)[0] + 1
 
             word_letters = []
+            word_bounds = []
             offset_left = 0
             offset_right = 5
             for i in range(0, len(letter_indices)):
@@ -129,98 +276,93 @@ def get_dataset(img, text, blur, resize):
                 # cv2.destroyAllWindows()
 
                 word_letters.append(letter)
+                word_bounds.append((line_row, word_col + y1 - offset_left, letter.shape[0], letter.shape[1]))
 
             line_letters.append(word_letters)
+            line_bounds.append(word_bounds)
 
         img_dataset.append(line_letters)
+        letter_bounds.append(line_bounds)
 
-    # Calculate each contour for every letter of the text
-    for line in img_dataset:
-        for word in line:
-            for i, letter in enumerate(word):
+    return img_dataset, inverted, letter_bounds
 
-                letter = np.pad(letter, [(5, 0), (0, 0)], mode='constant')
-                projection = np.sum(letter, axis=1)  # Compute column-wise sum of pixel values
-                black_rows = np.where(projection == 0)[0]  # Get indices of black rows
 
-                crop_position = np.argmax(
-                    np.diff(black_rows) > 30) + 1  # Find position where consecutive black rows exceed 10
-                if crop_position >= len(black_rows):
-                    crop_position = len(black_rows) - 1
+def clean_letter(letter):
+    # Crops the empty space under a letter and performs morphological "opening" to get rid of any noise.
+    # - letter: inverted image of one letter as returned by segment_letters
+    # - cleaned: the cleaned letter image
 
-                crop_row = black_rows[crop_position] + 30  # Get the row to crop at
-                letter = letter[:crop_row]  # Crop the image vertically
+    letter = np.pad(letter, [(5, 0), (0, 0)], mode='constant')
+    projection = np.sum(letter, axis=1)  # Compute column-wise sum of pixel values
+    black_rows = np.where(projection == 0)[0]  # Get indices of black rows
 
-                if np.all(letter == 0):
-
-                    height, width = letter.shape
-                    center_x = width // 2
-                    center_y = height // 2
-                    letter[center_y-2:center_y+3, center_x-2:center_x+3] = 255
-
-                kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-                word[i] = cv2.morphologyEx(letter, cv2.MORPH_OPEN, kernel)
-                word[i] = get_contour(word[i])
-
-    # Try reading as UTF-8 first
-    try:
-        with codecs.open(text, encoding='utf-8') as f:
-            lines = f.read().splitlines()
-    # If that fails, try reading as UTF-16
-    except UnicodeDecodeError:
-        with codecs.open(text, encoding='utf-16') as f:
-            lines = f.read().splitlines()
+    crop_position = np.argmax(
+        np.diff(black_rows) > 30) + 1  # Find position where consecutive black rows exceed 10
+    if crop_position >= len(black_rows):
+        crop_position = len(black_rows) - 1
 
-    ascii_dataset = []
+    crop_row = black_rows[crop_position] + 30  # Get the row to crop at
+    letter = letter[:crop_row]  # Crop the image vertically
 
-    for line in lines:
-        words = line.split(' ')
-        word_list = []
-        for word in words:
-            if len(word) > 0:
-                char_list = [str(char) for char in word]
-                word_list.append(char_list)
-        if len(word_list) > 0:
-            ascii_dataset.append(word_list)
+    if np.all(letter == 0):
 
-    print(ascii_dataset)
-    print(sum(len(elem) for sublist in ascii_dataset for elem in sublist for elem in elem))
-    print(sum(len(elem) for sublist in img_dataset for elem in sublist))
+        height, width = letter.shape
+        center_x = width // 2
+        center_y = height // 2
+        letter[center_y-2:center_y+3, center_x-2:center_x+3] = 255
 
-    print(ascii_dataset[4][5][1])
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    cleaned = cv2.morphologyEx(letter, cv2.MORPH_OPEN, kernel)
 
-    return img_dataset, ascii_dataset
+    return cleaned
 
 
-def divide_into_classes(img_dataset, ascii_dataset):
+def divide_into_classes(img_dataset, ascii_dataset, descriptors=None):
 
     # Divides the letters inside img_dataset into three classes, class1, class2, class3 depending on how many contours
     # each letter has. For every contour is puts into one of the three classes, it puts the corresponding ascii
     # character into the class as well.
     # - img_dataset: list of contours for every letter in every line and word of the text
     # - ascii_dataset: list of ascii characters for every letter in every line and word of the text
+    # - descriptors: the descriptor of every contour in the order of img_dataset, as returned by get_cached_dataset;
+    # if it is given, every class also gets the descriptors of its letters, so form_dataset does not compute them again
     # - class1, class2, class3: lists where the first elements are lists of the letters that belong to each class, and
-    # the second elements are lists of the ascii characters that belong to each class as 1-1 match with the letters
+    # the second elements are lists of the ascii characters that belong to each class as 1-1 match with the letters;
+    # with descriptors, the third elements are lists of the descriptors of the contours of each letter in one row
 
     class1 = [[], []]
     class2 = [[], []]
     class3 = [[], []]
 
+    if descriptors is not None:
+        for c in (class1, class2, class3):
+            c.append([])
+
+        # Row of the descriptors where the first contour of every letter is
+        starts = []
+        start = 0
+        for line in img_dataset:
+            starts.append([])
+            for word in line:
+                starts[-1].append([])
+                for letter in word:
+                    starts[-1][-1].append(start)
+                    start += len(letter)
+
     for line in range(min(len(img_dataset), len(ascii_dataset))):
         for word in range(min(len(img_dataset[line]), len(ascii_dataset[line]))):
             for letter in range(min(len(img_dataset[line][word]), len(ascii_dataset[line][word]))):
                 # Get the number of contours for the current letter
                 num_contours = len(img_dataset[line][word][letter])
+                if num_contours not in (1, 2, 3):
+                    continue
                 # Append the letter and its ascii character to the corresponding class
-                if num_contours == 1:
-                    class1[0].append(img_dataset[line][word][letter])
-                    class1[1].append(ascii_dataset[line][word][letter])
-                elif num_contours == 2:
-                    class2[0].append(img_dataset[line][word][letter])
-                    class2[1].append(ascii_dataset[line][word][letter])
-                elif num_contours == 3:
-                    class3[0].append(img_dataset[line][word][letter])
-                    class3[1].append(ascii_dataset[line][word][letter])
+                c = (class1, class2, class3)[num_contours - 1]
+                c[0].append(img_dataset[line][word][letter])
+                c[1].append(ascii_dataset[line][word][letter])
+                if descriptors is not None:
+                    start = starts[line][word][letter]
+                    c[2].append(descriptors[start:start + num_contours].reshape(-1))
 
     print(class1[1])
     print(class2[1])
@@ -230,66 +372,42 @@ def divide_into_classes(img_dataset, ascii_dataset):
 
 
 def form_dataset(class1, class2, class3, N):
-    # Forms the final dataset that is to be passed to the KNN algorithm. Each row of the dataset is the descriptors for
-    # each letter of the class plus the label of the letter. The label is just the ascii character that is stored in the
-    # second list of the class.
+    # Forms the final dataset that is to be passed to the KNN algorithm. Each dataset is a pair of a feature matrix and
+    # a label array. Each row of the feature matrix is the descriptors for each letter of the class and the label is
+    # just the ascii character that is stored in the second list of the class. The feature matrix of every class is
+    # allocated once, as a float32 array, by get_letter_descriptors, or stacked from the descriptors the classes already
+    # have.
     # - class1, class2, class3: the input classes each one containing a list of the letter contours and a list of the
-    # corresponding ascii characters
-    # - N: the size of the fixed-length descriptors
-    # - dataset1, dataset2, dataset3: one dataset for each class as mentioned above
-
-    dataset1 = pd.DataFrame()
-    dataset2 = pd.DataFrame()
-    dataset3 = pd.DataFrame()
-
-    # process class1
-    for i in range(len(class1[0])):
-        letter = class1[0][i]
-        label = class1[1][i]
-
-        descriptor = get_descriptor(letter[0])
-
-        # Interpolate descriptor so it is of fixed size
-        interpolation_points = np.linspace(0, 1, N)
-        descriptor = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor)), descriptor)
-
-        row = np.concatenate((descriptor, [label]))  # add the label to the descriptor
-        dataset1 = pd.concat([dataset1, pd.DataFrame([row])])
-
-    # process class2
-    for i in range(len(class2[0])):
-        letter1, letter2 = class2[0][i]
-        label = class2[1][i]
-
-        descriptor1 = get_descriptor(letter1)
-        descriptor2 = get_descriptor(letter2)
-
-        # Interpolate descriptor so it is of fixed size
-        interpolation_points = np.linspace(0, 1, N)
-        descriptor1 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor1)), descriptor1)
-        descriptor2 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor2)), descriptor2)
+    # corresponding ascii characters, and optionally a list of the descriptors of each letter, see divide_into_classes
+    # - N: the number of points every contour is resampled to, each contour gives N - 1 descriptors
+    # - dataset1, dataset2, dataset3: one (features, labels) pair for each class as mentioned above
+
+    datasets = []
+
+    for num_contours, c in enumerate((class1, class2, class3), start=1):
+        letters, labels = c[0], c[1]
+        if len(letters) == 0:
+            features = np.empty((0, num_contours * (N - 1)), dtype=np.float32)
+        elif len(c) > 2:
+            features = np.array(c[2], dtype=np.float32)
+        else:
+            features = get_letter_descriptors(letters, N)
+        datasets.append((features, np.array(labels, dtype=str)))
 
-        row = np.concatenate((descriptor1, descriptor2, [label]))  # add the label and the two descriptors
-        dataset2 = pd.concat([dataset2, pd.DataFrame([row])])
+    dataset1, dataset2, dataset3 = datasets
 
-    # process class3
-    for i in range(len(class3[0])):
-        letter1, letter2, letter3 = class3[0][i]
-        label = class3[1][i]
+    return dataset1, dataset2, dataset3
 
-        descriptor1 = get_descriptor(letter1)
-        descriptor2 = get_descriptor(letter2)
-        descriptor3 = get_descriptor(letter3)
 
-        # Interpolate descriptor so it is of fixed size
-        interpolation_points = np.linspace(0, 1, N)
-        descriptor1 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor1)), descriptor1)
-        descriptor2 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor2)), descriptor2)
-        descriptor3 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor3)), descriptor3)
+def dataset_to_frame(dataset):
+    # Returns a DataFrame view of a dataset formed by form_dataset, where each row is the descriptors of a letter plus
+    # its label in the last column.
+    # - dataset: (features, labels) pair of one class
+    # - frame: the dataset as a DataFrame
 
-        row = np.concatenate(
-            (descriptor1, descriptor2, descriptor3, [label]))  # add the label and the three descriptors
-        dataset3 = pd.concat([dataset3, pd.DataFrame([row])])
+    features, labels = dataset
 
-    return dataset1, dataset2, dataset3
+    frame = pd.DataFrame(features)
+    frame[features.shape[1]] = labels  # add the label after the descriptors
 
+    return frame
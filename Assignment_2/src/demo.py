@@ -11,7 +11,7 @@ start_time = time.time()
 x = cv2.imread("text1_v3.png")
 text = "text1_v3.txt"
 
-lines = read_text(x, text)
+lines = read_text(x, text, cache_dir="cache")
 
 elapsed_time = time.time() - start_time
 
@@ -1,4 +1,5 @@
 import numpy as np
+import instrumentation
 
 
 def get_descriptor(contour):
@@ -18,3 +19,48 @@ def get_descriptor(contour):
     descriptor = np.abs(R)
 
     return descriptor
+
+
+@instrumentation.timed("descriptors")
+def get_descriptors(contours, N):
+    # Batch version of get_descriptor for every contour of a page. First resamples every contour to N points with linear
+    # interpolation, all contours at once, and then takes the DFT of all the resampled sequences with a single 2-D FFT.
+    # As in get_descriptor the descriptor of each contour is the absolute value of its DFT without the first term.
+    # - contours: a list of contours, each one a list of the points that make up the contour
+    # - N: the number of points every contour is resampled to
+    # - descriptors: contiguous (len(contours), N - 1) float32 matrix with the descriptor of each contour in each row
+
+    if len(contours) == 0:
+        return np.empty((0, N - 1), dtype=np.float32)
+
+    # Put the complex sequences r[i] = x[i] + jy[i] of all contours one after the other
+    lengths = np.array([len(contour) for contour in contours])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    points = np.concatenate([np.asarray(contour, dtype=np.float64).reshape(-1, 2) for contour in contours])
+    r = points[:, 0] + 1j * points[:, 1]
+
+    # Resample each sequence at N equally spaced positions between its first and its last point
+    positions = np.linspace(0, 1, N)[np.newaxis, :] * (lengths[:, np.newaxis] - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, lengths[:, np.newaxis] - 1)
+    weight = positions - lower
+    r = (1 - weight) * r[starts[:, np.newaxis] + lower] + weight * r[starts[:, np.newaxis] + upper]
+
+    # Take the DFT of every row, remove the first term and keep the absolute value of the remaining terms
+    R = np.fft.fft(r, axis=1)
+    descriptors = np.ascontiguousarray(np.abs(R[:, 1:]), dtype=np.float32)
+
+    return descriptors
+
+
+def get_letter_descriptors(letters, N):
+    # Computes the descriptors of letters that all have the same number of contours with one call to get_descriptors.
+    # The descriptors of the contours of each letter are placed one after the other in the same row.
+    # - letters: a list of letters, each one a list of its contours
+    # - N: the number of points every contour is resampled to
+    # - descriptors: (len(letters), number of contours * (N - 1)) float32 matrix with one row for each letter
+
+    contours = [contour for letter in letters for contour in letter]
+    descriptors = get_descriptors(contours, N)
+
+    return descriptors.reshape(len(letters), -1)
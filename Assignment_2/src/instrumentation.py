@@ -0,0 +1,140 @@
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Setting the environment variable PROFILE_ENV to the path of a JSON file enables the instrumentation for the whole run
+# and saves the report there when the program exits. Worker processes inherit the variable but do not save a report.
+PROFILE_ENV = "DIP_PROFILE"
+
+_enabled = False
+_path = None
+_pid = None
+_start_time = None
+_stages = {}
+_counters = {}
+
+
+class _Stage:
+    # Context manager that adds the time spent inside it to a named stage. The peak memory is only reported for the
+    # whole run, since the peak resident memory of a process never decreases.
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed_time = time.perf_counter() - self.start_time
+        record = _stages.setdefault(self.name, {'calls': 0, 'time': 0.0})
+        record['calls'] += 1
+        record['time'] += elapsed_time
+        return False
+
+
+def enable(path=None):
+    # Starts collecting stage times and counters, clearing anything collected before.
+    # - path: the path of the JSON report that is saved when the program exits by the process that calls enable; if it
+    # is None the path given before is kept, and no report is saved if there is none
+
+    global _enabled, _path, _pid, _start_time
+
+    if path is not None and _path is None:
+        atexit.register(_save_at_exit)
+    if path is not None:
+        _path = path
+        _pid = os.getpid()
+
+    _enabled = True
+    _start_time = time.perf_counter()
+    _stages.clear()
+    _counters.clear()
+
+
+def is_enabled():
+    return _enabled
+
+
+def timed(name):
+    # Decorator that times every call of a function as the stage name. While the instrumentation is disabled the only
+    # cost is the check of a flag.
+    # - name: the name of the stage
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, n=1):
+    # Adds n to the counter name.
+    # - name: the name of the counter
+    # - n: the amount to add
+
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def get_peak_memory(children=False):
+    # Returns the peak resident memory of the process in bytes, or None where it is not available.
+    # - children: if True, returns the largest peak of the worker processes that have finished instead
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_report():
+    # Collects the stage times, the counters and the peak memory of the run so far.
+    # - report: dictionary that can be saved as JSON
+
+    report = {
+        'argv': sys.argv,
+        'total_time': time.perf_counter() - _start_time if _start_time is not None else 0.0,
+        'peak_memory': get_peak_memory(),
+        'children_peak_memory': get_peak_memory(children=True),
+        'stages': {name: dict(record) for name, record in _stages.items()},
+        'counters': dict(_counters),
+    }
+
+    return report
+
+
+def save_report(path):
+    # Saves the report of get_report as a JSON file.
+    # - path: the path of the JSON file
+
+    with open(path, "w") as f:
+        json.dump(get_report(), f, indent=2)
+
+
+def _save_at_exit():
+    # Only the process that enabled the instrumentation, or that started the run for PROFILE_ENV, saves the report
+    if _enabled and _path is not None and os.environ.get(PROFILE_ENV + "_PID", str(_pid)) == str(os.getpid()):
+        save_report(_path)
+
+
+if os.environ.get(PROFILE_ENV):
+    # Only the process that started the run saves the report
+    os.environ.setdefault(PROFILE_ENV + "_PID", str(os.getpid()))
+    enable(os.environ[PROFILE_ENV])
@@ -1,68 +1,34 @@
-from dataset import *
+from cache import *
 from traintest import *
+import argparse
+import contextlib
+import instrumentation
+import pickle
+import sklearn
+import time
 
+# Bump MODEL_FORMAT when the keys of the model dictionary change
+MODEL_FORMAT = 1
 
-def read_text(img, text):
+
+def read_text(img, text, cache_dir=None, workers=1):
     # Trains and tests the model on the image, calculates the confusion matrix and weighted accuracy. Then reads text.
     # - img: the input image containing the text we want to read
     # - text: the text used for model training
+    # - cache_dir: directory of the descriptor cache of get_cached_dataset, the cache is not used if it is None
+    # - workers: the number of worker processes that calculate the contours of the letters
     # - lines: list containing in each element the text (in ascii) of one line of the image
 
     img = cv2.resize(img, (0, 0), fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR)
-    N = 100  # number of frequencies for each contour
-    img_dataset, ascii_dataset = get_dataset(img, text, 17, 7)
-    class1, class2, class3 = divide_into_classes(img_dataset, ascii_dataset)
-    dataset1, dataset2, dataset3 = form_dataset(class1, class2, class3, N)
-
-    c1, w1, knn1 = train_test(dataset1)
-    print("weighted accuracy for class1: ", w1)
-    c2, w2, knn2 = train_test(dataset2)
-    print("weighted accuracy for class2: ", w2)
-    c3, w3, knn3 = train_test(dataset3)
-    print("weighted accuracy for class3: ", w3)
+    model = train_model(img, text, cache_dir=cache_dir, workers=workers)
 
     xx = cv2.imread("text2_rot.png")
     # xx = cv2.resize(xx, (0, 0), fx=2.5, fy=2.5, interpolation=cv2.INTER_LINEAR)
-    img_dataset, ascii_dataset = get_dataset(xx, "text2.txt", 17, 7)
+    img_dataset, ascii_dataset, descriptors = get_cached_dataset(xx, "text2.txt", model['blur'], model['resize'],
+                                                                 model['N'], cache_dir, workers=workers)
 
     # Predict labels for each letter and store the result in an ascii list
-    lines = []
-    for line_idx, line in enumerate(img_dataset):
-        ascii_line = []
-        for word_idx, word in enumerate(line):
-            ascii_word = []
-            for letter_idx, letter in enumerate(word):
-
-                num_contours = len(img_dataset[line_idx][word_idx][letter_idx])
-
-                if num_contours == 1:
-                    descriptor = get_descriptor(letter[0])
-                    interpolation_points = np.linspace(0, 1, N)
-                    descriptor = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor)), descriptor)
-                    row = pd.DataFrame(descriptor).T
-                    predicted_label = knn1.predict(row)[0]
-                elif num_contours == 2:
-                    descriptor1 = get_descriptor(letter[0])
-                    descriptor2 = get_descriptor(letter[1])
-                    interpolation_points = np.linspace(0, 1, N)
-                    descriptor1 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor1)), descriptor1)
-                    descriptor2 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor2)), descriptor2)
-                    row = pd.DataFrame(np.concatenate((descriptor1, descriptor2))).T
-                    predicted_label = knn2.predict(row)[0]
-                else:
-                    descriptor1 = get_descriptor(letter[0])
-                    descriptor2 = get_descriptor(letter[1])
-                    descriptor3 = get_descriptor(letter[2])
-                    interpolation_points = np.linspace(0, 1, N)
-                    descriptor1 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor1)), descriptor1)
-                    descriptor2 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor2)), descriptor2)
-                    descriptor3 = np.interp(interpolation_points, np.linspace(0, 1, len(descriptor3)), descriptor3)
-                    row = pd.DataFrame(np.concatenate((descriptor1, descriptor2, descriptor3))).T
-                    predicted_label = knn3.predict(row)[0]
-
-                ascii_word.append(str(predicted_label))
-            ascii_line.append(ascii_word)
-        lines.append(ascii_line)
+    lines = predict_letters(img_dataset, model, descriptors)
 
     # Save the result to a text file
     with open("output.txt", "w") as f:
@@ -96,3 +62,169 @@ def read_text(img, text):
     print((matching_chars / total_chars) * 100)
 
     return lines
+
+
+@instrumentation.timed("training")
+def train_model(img, text, N=100, blur=17, resize=7, cache_dir=None, workers=1):
+    # Trains one KNN model for each class of letters, depending on how many contours they have, on the letters of a
+    # text image and prints the weighted accuracy of each model.
+    # - img: the training image
+    # - text: the text document of the training image
+    # - N: the number of points each contour is resampled to
+    # - blur, resize: the segmentation parameters of segment_letters
+    # - cache_dir: directory of the descriptor cache of get_cached_dataset, the cache is not used if it is None
+    # - workers: the number of worker processes that calculate the contours of the letters
+    # - model: dictionary with the three KNN models 'knn1', 'knn2', 'knn3' (None if their class could not be trained),
+    # the parameters 'N', 'blur', 'resize' and the sorted list of all the labels the models know, 'vocabulary'
+
+    img_dataset, ascii_dataset, descriptors = get_cached_dataset(img, text, blur, resize, N, cache_dir, workers=workers)
+    class1, class2, class3 = divide_into_classes(img_dataset, ascii_dataset, descriptors)
+    dataset1, dataset2, dataset3 = form_dataset(class1, class2, class3, N)
+
+    c1, w1, knn1 = train_test(dataset1)
+    print("weighted accuracy for class1: ", w1)
+    c2, w2, knn2 = train_test(dataset2)
+    print("weighted accuracy for class2: ", w2)
+    c3, w3, knn3 = train_test(dataset3)
+    print("weighted accuracy for class3: ", w3)
+
+    vocabulary = sorted(set(class1[1]) | set(class2[1]) | set(class3[1]))
+
+    model = {'knn1': knn1, 'knn2': knn2, 'knn3': knn3, 'N': N, 'blur': blur, 'resize': resize,
+             'vocabulary': vocabulary}
+
+    return model
+
+
+def save_model(model, path):
+    # Saves a model returned by train_model, together with the model format and the scikit-learn version it was
+    # trained with, so that later runs can load it instead of training again.
+    # - model: the model returned by train_model
+    # - path: the path of the model file
+
+    artifact = dict(model, format=MODEL_FORMAT, sklearn_version=sklearn.__version__)
+
+    with open(path, "wb") as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_model(path):
+    # Loads a model saved by save_model. The file is unpickled, so it must come from a trusted source.
+    # - path: the path of the model file
+    # - model: the model, as returned by train_model
+
+    with open(path, "rb") as f:
+        artifact = pickle.load(f)
+
+    if artifact.pop('format', None) != MODEL_FORMAT:
+        raise ValueError("Unsupported model format in " + path)
+    if artifact.pop('sklearn_version') != sklearn.__version__:
+        print("Warning: the model was saved with a different scikit-learn version")
+
+    return artifact
+
+
+@instrumentation.timed("knn")
+def predict_letters(img_dataset, model, descriptors=None):
+    # Predicts the ascii character of every letter of img_dataset with the KNN model of its class. The letters are
+    # grouped by their number of contours, so each model predicts all the letters of its class with a single call,
+    # and the labels are then put back in the place of their letters. Letters without any contour, or of a class that
+    # had too few training letters to train a model, are read as "?".
+    # - img_dataset: a list containing the contour of each letter of a text image
+    # - model: the model returned by train_model
+    # - descriptors: the descriptor of every contour in the order of img_dataset, as returned by get_cached_dataset;
+    # they are computed if it is None
+    # - lines: list containing in each element the letters (in ascii) of each word of one line of the image
+
+    N = model['N']
+
+    if descriptors is None:
+        descriptors = get_descriptors(flatten_contours(img_dataset), N)
+
+    # Number of contours of every letter and the row of the descriptors where its first contour is
+    num_contours = np.array([len(letter) for line in img_dataset for word in line for letter in word], dtype=int)
+    starts = np.concatenate(([0], np.cumsum(num_contours)[:-1])).astype(int)
+
+    labels = np.full(len(num_contours), "?", dtype=object)
+    instrumentation.count("letters_predicted", len(num_contours))
+    for k, knn in ((1, model['knn1']), (2, model['knn2']), (3, model['knn3'])):
+        # Letters with more than three contours are classified by their first three
+        letter_indices = np.where(num_contours == k)[0] if k < 3 else np.where(num_contours >= k)[0]
+        if len(letter_indices) == 0 or knn is None:
+            continue
+        rows = starts[letter_indices, np.newaxis] + np.arange(k)
+        features = descriptors[rows].reshape(len(letter_indices), -1)
+        labels[letter_indices] = [str(label) for label in knn.predict(features)]
+
+    # Put the labels back in the line, word, letter structure of img_dataset
+    lines = []
+    index = 0
+    for line in img_dataset:
+        ascii_line = []
+        for word in line:
+            ascii_line.append(list(labels[index:index + len(word)]))
+            index += len(word)
+        lines.append(ascii_line)
+
+    return lines
+
+
+def read_pages(pages, model, workers=1):
+    # Reads a document page by page and yields each line of text as soon as its page has been read. Only one page is
+    # held in memory at a time, so the pages can be an arbitrarily long (lazy) iterable.
+    # - pages: iterable of the page images, either paths or images loaded with cv2.imread
+    # - model: the model returned by train_model
+    # - workers: the number of worker processes that calculate the contours of the letters
+    # - line: the text of one line, with the words separated by spaces
+
+    for page in pages:
+        img = cv2.imread(page) if isinstance(page, str) else page
+        if img is None:
+            raise FileNotFoundError("Could not read page image: " + str(page))
+
+        img_dataset = get_img_dataset(img, model['blur'], model['resize'], workers)
+        del img
+
+        for line in predict_letters(img_dataset, model):
+            yield " ".join("".join(word) for word in line)
+
+
+def main(argv=None):
+    # Command line entry point. Trains the model once, or loads it from a file saved by save_model, and prints the lines
+    # of every page to stdout as they are read. Everything else that is printed on the way goes to stderr.
+
+    parser = argparse.ArgumentParser(description="Read the text of one or more page images.")
+    parser.add_argument("pages", nargs="+", help="paths of the page images, in reading order")
+    parser.add_argument("--train-image", default="text1_v3.png", help="image the model is trained on")
+    parser.add_argument("--train-text", default="text1_v3.txt", help="text document of the training image")
+    parser.add_argument("--train-scale", type=float, default=0.5, help="factor the training image is resized by")
+    parser.add_argument("--cache-dir", default=None, help="directory of the descriptor cache")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--model", default=None, help="load the model from this file instead of training it")
+    parser.add_argument("--save-model", default=None, help="save the trained model to this file")
+    parser.add_argument("--profile", default=None, help="save the time of every stage to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.profile is not None:
+        instrumentation.enable(args.profile)
+
+    stdout = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        start_time = time.time()
+        if args.model is not None:
+            model = load_model(args.model)
+        else:
+            img = cv2.imread(args.train_image)
+            img = cv2.resize(img, (0, 0), fx=args.train_scale, fy=args.train_scale, interpolation=cv2.INTER_LINEAR)
+            model = train_model(img, args.train_text, cache_dir=args.cache_dir, workers=args.workers)
+        print("Model ready in", (time.time() - start_time) * 1000, "ms")
+
+        if args.save_model is not None:
+            save_model(model, args.save_model)
+
+        for line in read_pages(args.pages, model, args.workers):
+            print(line, file=stdout, flush=True)
+
+
+if __name__ == "__main__":
+    main()
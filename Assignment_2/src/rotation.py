@@ -1,14 +1,19 @@
 import imutils as imutils
 import numpy as np
 import cv2
+import instrumentation
 
 
-def find_rotation_angle(x):
+@instrumentation.timed("rotation")
+def find_rotation_angle(x, refinement="sweep"):
     # Finds the angle a text image might have been rotated. First blurs the image so that the letters of each line
     # attach with each other and then takes the logarithm of the magnitude of the image's DFT. Based on the maximum
     # frequency, which corresponds to the difference in brightness from one line to the next, it calculates the angle
-    # the image has been rotated in regard to the x-axis
+    # the image has been rotated in regard to the x-axis. The angle is then refined in a window of +-1 degree around it
+    # by maximizing the gradient of the horizontal projection of the rotated image.
     # - x: the input image
+    # - refinement: "sweep" tries every 0.05 degrees of the window on the full image, "ink" scores the same angles with
+    # projection_gradient_scores and "coarse_to_fine" uses refine_angle_coarse_to_fine
     # - angle: the angle the text image might have been rotated
 
     # Convert the image to grayscale
@@ -66,6 +71,15 @@ def find_rotation_angle(x):
         else:
             angle = - np.rad2deg(angle) - 90.0
 
+    if refinement == "coarse_to_fine":
+        return refine_angle_coarse_to_fine(grayscale, angle)
+    if refinement == "ink":
+        candidates = angle - np.arange(-1, 1, 0.05)
+        scores = projection_gradient_scores(grayscale, candidates)
+        return candidates[int(np.argmax(scores))]
+    if refinement != "sweep":
+        raise ValueError("Unknown rotation refinement: " + str(refinement))
+
     best_angle = angle
     best_gradient = -np.inf
     for delta in np.arange(-1, 1, 0.05):
@@ -81,6 +95,147 @@ def find_rotation_angle(x):
     return angle
 
 
+def refine_angle_coarse_to_fine(grayscale, angle, window=1.0, coarse_step=0.25, scale=0.25, tolerance=0.05):
+    # Refines the rotation angle in two steps. First tries every coarse_step degrees of the window on a downsampled copy
+    # of the image, then narrows the interval around the best coarse angle with golden-section search on the full
+    # image. The full image is rotated only about log(2 * coarse_step / tolerance) / log(1.618) times.
+    # - grayscale: the grayscale input image
+    # - angle: the initial estimation of the angle
+    # - window: the angle is searched in [angle - window, angle + window]
+    # - coarse_step: the step of the coarse search in degrees
+    # - scale: the factor the image is downsampled by for the coarse search
+    # - tolerance: the width of the final interval of the golden-section search in degrees
+    # - angle: the refined angle
+
+    small = cv2.resize(grayscale, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    candidates = angle + np.arange(-window, window + coarse_step / 2, coarse_step)
+    scores = [projection_gradient_score(small, candidate) for candidate in candidates]
+    best_angle = candidates[int(np.argmax(scores))]
+
+    # Golden-section search for the maximum of the score
+    ratio = (np.sqrt(5) - 1) / 2
+    low, high = best_angle - coarse_step, best_angle + coarse_step
+    left, right = high - ratio * (high - low), low + ratio * (high - low)
+    left_score, right_score = projection_gradient_score(grayscale, left), projection_gradient_score(grayscale, right)
+    while high - low > tolerance:
+        if left_score > right_score:
+            high, right, right_score = right, left, left_score
+            left = high - ratio * (high - low)
+            left_score = projection_gradient_score(grayscale, left)
+        else:
+            low, left, left_score = left, right, right_score
+            right = low + ratio * (high - low)
+            right_score = projection_gradient_score(grayscale, right)
+    angle = (low + high) / 2
+
+    return angle
+
+
+def projection_gradient_score(x, angle):
+    # Scores a candidate rotation angle of a text image. When the text lines are horizontal the horizontal projection
+    # of the image changes sharply from one line to the next, so the score is the total absolute gradient of the
+    # projection of the image rotated back by the angle.
+    # - x: the input image
+    # - angle: the candidate rotation angle
+    # - score: the sum of the absolute gradient of the projection
+
+    rotated = rotate_image(x, -angle)
+    projection = np.sum(rotated, axis=1, dtype=np.float64)
+    score = np.sum(np.abs(np.gradient(projection, axis=0)))
+
+    return score
+
+
+def projection_gradient_scores(x, angles, chunk_size=8, block_size=16384):
+    # Computes projection_gradient_score for many angles without rotating the image. The rotated image is white except
+    # for the ink, so its horizontal projection is a constant minus the projection of the darkness of the ink pixels.
+    # That projection is built by moving the row of every ink pixel with the rotation matrix of rotate_image and
+    # splitting its darkness between the two nearest rows with np.bincount, as the linear interpolation of
+    # cv2.warpAffine does. The angles are processed in chunks of chunk_size and the ink pixels in blocks of block_size,
+    # whose projections are added up, so the memory grows neither with the number of angles nor with the ink, apart
+    # from the compact list of the ink pixels.
+    # - x: the input image
+    # - angles: the candidate rotation angles
+    # - chunk_size: the number of angles scored together
+    # - block_size: the number of ink pixels moved together
+    # - scores: the score of each angle
+
+    if len(x.shape) == 3:
+        x = cv2.cvtColor(x, cv2.COLOR_BGR2GRAY)
+    height, width = x.shape[:2]
+
+    rows, cols, darkness = get_ink_pixels(x)
+
+    angles = np.asarray(angles, dtype=np.float64)
+    scores = np.empty(len(angles))
+
+    for start in range(0, len(angles), chunk_size):
+        chunk = angles[start:start + chunk_size]
+
+        # Second row of the matrix of rotate_image(x, -angle) and the height of the rotated image
+        alpha = np.cos(np.deg2rad(-chunk))
+        beta = np.sin(np.deg2rad(-chunk))
+        new_heights = (height * np.abs(alpha) + width * np.abs(beta)).astype(int)
+        offsets = beta * (width / 2) + (1 - alpha) * (height / 2) + (new_heights - height) / 2
+
+        num_rows = new_heights.max() + 3
+        chunk_offsets = (np.arange(len(chunk)) * num_rows)[:, np.newaxis]
+        projections = np.zeros(len(chunk) * num_rows)
+
+        for block in range(0, len(rows), block_size):
+            block_rows = rows[block:block + block_size]
+            block_cols = cols[block:block + block_size]
+            block_darkness = darkness[block:block + block_size]
+
+            # Row of every ink pixel in every rotated image, split between the row above and the row below. The rows
+            # are shifted down by one so that the ink that falls just above the rotated image gets a bin of its own.
+            y = np.outer(-beta, block_cols) + np.outer(alpha, block_rows) + offsets[:, np.newaxis]
+            lower = np.floor(y)
+            fraction = y - lower
+
+            bins = np.clip(lower.astype(np.int32) + 1, 0, num_rows - 2) + chunk_offsets
+            projections += np.bincount(bins.ravel(), (block_darkness * (1 - fraction)).ravel(), len(chunk) * num_rows)
+            projections += np.bincount((bins + 1).ravel(), (block_darkness * fraction).ravel(), len(chunk) * num_rows)
+
+        projections = projections.reshape(len(chunk), num_rows)
+
+        for i in range(len(chunk)):
+            projection = projections[i, 1:new_heights[i] + 1]
+            scores[start + i] = np.sum(np.abs(np.gradient(projection)))
+
+    return scores
+
+
+def get_ink_pixels(grayscale, band_height=256):
+    # Finds the ink pixels of a grayscale image, the pixels that are not white. The image is scanned in bands of rows,
+    # once to count the ink and once to fill the arrays, so that only one band of the mask and of the indices of
+    # np.nonzero exists at a time.
+    # - grayscale: the grayscale input image
+    # - band_height: the number of rows scanned together
+    # - rows, cols: the coordinates of the ink pixels, in the smallest unsigned integer type that fits the image
+    # - darkness: 255 minus the value of each ink pixel
+
+    height, width = grayscale.shape[:2]
+    bands = range(0, height, band_height)
+    num_ink = sum(np.count_nonzero(grayscale[band:band + band_height] < 255) for band in bands)
+
+    coordinate_type = np.min_scalar_type(max(height, width))
+    rows = np.empty(num_ink, dtype=coordinate_type)
+    cols = np.empty(num_ink, dtype=coordinate_type)
+    darkness = np.empty(num_ink, dtype=np.uint8)
+
+    start = 0
+    for band in bands:
+        band_rows, band_cols = np.nonzero(grayscale[band:band + band_height] < 255)
+        end = start + len(band_rows)
+        rows[start:end] = band_rows + band
+        cols[start:end] = band_cols
+        darkness[start:end] = 255 - grayscale[band_rows + band, band_cols]
+        start = end
+
+    return rows, cols, darkness
+
+
 def rotate_image(x, angle):
     # Rotates an image x at an angle (positive or negative). The spaces are filled using the appropriate padding.
     # - x: the input image
@@ -9,20 +9,25 @@ from sklearn.utils import compute_sample_weight
 def train_test(dataset, n_neighbors=1):
     # Passes the dataset into the KNN algorithm which trains and tests the model in order to calculate the confusion
     # matrix and the weighted accuracy.
-    # - dataset: input dataset of the letters
+    # - dataset: input dataset of the letters, either a (features, labels) pair as formed by form_dataset or a DataFrame
+    # with the labels in the last column
     # - conf_matrix, weighted_accuracy: return parameters
 
-    if dataset.empty:
-        return None, None
-
-    x = dataset.iloc[:, :-1]  # Select all columns except the last one
-    y = dataset.iloc[:, -1]  # Select only the last column (labels)
+    if isinstance(dataset, pd.DataFrame):
+        if dataset.empty:
+            return None, None, None
+        x = dataset.iloc[:, :-1].to_numpy(dtype=np.float32)  # Select all columns except the last one
+        y = dataset.iloc[:, -1].to_numpy(dtype=str)  # Select only the last column (labels)
+    else:
+        x, y = dataset
+        if len(y) == 0:
+            return None, None, None
 
     # duplicate rows for classes with only one member
     unique_classes, class_counts = np.unique(y, return_counts=True)
     for c in unique_classes[class_counts == 1]:
         indices = np.where(y == c)[0]
-        x = pd.concat([x, x.iloc[indices]], axis=0)
+        x = np.concatenate([x, x[indices]], axis=0)
         y = np.concatenate([y, np.repeat(c, len(indices))], axis=0)
 
     testing_size = 30
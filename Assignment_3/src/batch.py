@@ -0,0 +1,218 @@
+from harrisDetector import *
+from matchDescriptor import *
+from ransac import *
+from imageStitching import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import csv
+import instrumentation
+import os
+import sys
+import time
+import traceback
+
+RESULT_FIELDS = ['img1', 'img2', 'output', 'status', 'error', 'corners1', 'corners2', 'matches', 'inliers', 'theta',
+                 'd_row', 'd_col', 'detect_time', 'describe_time', 'match_time', 'ransac_time', 'stitch_time',
+                 'total_time']
+
+
+def stitch_batch(pairs, results_path, workers=None, Rthres=0.15, r=20, N=10000, ratio=0.8, min_inliers=10):
+    # Stitches many image pairs in a pool of worker processes and writes one row for every pair to a CSV results file,
+    # as soon as the pair is done. A pair that fails is recorded with its error and does not stop the others, also when
+    # its worker process dies and the pair has no result. While the instrumentation is enabled, the stage times and the
+    # counters of every pair are collected in its worker and merged into the report of this process.
+    # - pairs: list of (img1 path, img2 path, output path) tuples
+    # - results_path: the path of the CSV results file
+    # - workers: the number of worker processes, the number of CPUs if it is None
+    # - Rthres, r, N, ratio, min_inliers: the parameters of stitch_pair
+    # - num_failed: the number of pairs that failed
+
+    num_failed = 0
+
+    with open(results_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        f.flush()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(instrumentation.is_enabled(),)) as executor:
+            futures = {executor.submit(stitch_pair_in_worker, img1, img2, output, Rthres, r, N, ratio, min_inliers):
+                       (img1, img2, output) for img1, img2, output in pairs}
+
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                    snapshot = result.pop('instrumentation', None)
+                    if snapshot is not None:
+                        instrumentation.merge(snapshot)
+                except Exception as e:
+                    img1, img2, output = futures[future]
+                    result = {'img1': img1, 'img2': img2, 'output': output, 'status': "failed",
+                              'error': "".join(traceback.format_exception_only(type(e), e)).strip()}
+                if result['status'] != "ok":
+                    num_failed += 1
+                    print("Failed:", result['img1'], result['img2'], ":", result['error'], file=sys.stderr)
+                writer.writerow(result)
+                f.flush()
+
+    return num_failed
+
+
+def init_worker(profile):
+    # Prepares a worker process of stitch_batch. The pairs are processed in parallel already, so OpenCV uses one thread.
+    # - profile: whether the instrumentation of the worker is enabled
+
+    cv2.setNumThreads(1)
+    if profile:
+        instrumentation.enable()
+
+
+def stitch_pair_in_worker(*args):
+    # Work unit of stitch_batch. Runs stitch_pair and, while the instrumentation is enabled, returns the stage times
+    # and the counters of the pair in the 'instrumentation' field of the result.
+    # - args: the arguments of stitch_pair
+    # - result: the result of stitch_pair
+
+    if not instrumentation.is_enabled():
+        return stitch_pair(*args)
+
+    instrumentation.enable()
+    result = stitch_pair(*args)
+    result['instrumentation'] = instrumentation.get_snapshot()
+
+    return result
+
+
+def stitch_pair(img1_path, img2_path, output_path, Rthres=0.15, r=20, N=10000, ratio=0.8, min_inliers=10):
+    # Runs the whole pipeline on one pair of images: Harris corners, descriptors, matching with the ratio test, RANSAC
+    # and stitching, and saves the stitched image. Any error is caught and returned in the result, so that it can be
+    # reported without stopping the other pairs of a batch. A pair whose transform has fewer than min_inliers inliers
+    # does not overlap enough to be stitched and fails without an output image.
+    # - img1_path, img2_path: the paths of the images
+    # - output_path: the path of the stitched image
+    # - Rthres: the threshold of detect_harris_features
+    # - r, N: the parameters of my_RANSAC
+    # - ratio: the ratio of match_descriptors_ratio
+    # - min_inliers: the minimum number of inliers of the transform; the random matches of images that do not overlap
+    # give up to about 7 inliers with r = 20
+    # - result: dictionary with the fields of RESULT_FIELDS
+
+    result = {'img1': img1_path, 'img2': img2_path, 'output': output_path, 'status': "ok", 'error': ""}
+    start_time = time.time()
+
+    try:
+        img1 = cv2.imread(img1_path)
+        img2 = cv2.imread(img2_path)
+        if img1 is None or img2 is None:
+            raise FileNotFoundError("Could not read " + (img1_path if img1 is None else img2_path))
+        img1_g = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+        img2_g = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+
+        stage_time = time.time()
+        corners1 = detect_harris_features(img1_g, Rthres)
+        corners2 = detect_harris_features(img2_g, Rthres)
+        result['corners1'], result['corners2'] = len(corners1), len(corners2)
+        result['detect_time'] = time.time() - stage_time
+
+        stage_time = time.time()
+        descriptors1, valid1 = get_descriptors(img1_g, corners1, 5, 20, 0.5, 8, dense=True)
+        descriptors2, valid2 = get_descriptors(img2_g, corners2, 5, 20, 0.5, 8, dense=True)
+        result['describe_time'] = time.time() - stage_time
+
+        stage_time = time.time()
+        indices1, indices2 = match_descriptors_ratio(descriptors1, valid1, descriptors2, valid2, ratio)
+        matching_points = [(corners1[i], corners2[j]) for i, j in zip(indices1, indices2)]
+        result['matches'] = len(matching_points)
+        result['match_time'] = time.time() - stage_time
+
+        stage_time = time.time()
+        H, inlier_matching_points, _ = my_RANSAC(matching_points, r, N)
+        result['inliers'] = len(inlier_matching_points)
+        result['theta'] = H['theta']
+        result['d_row'], result['d_col'] = H['d']
+        result['ransac_time'] = time.time() - stage_time
+        if len(inlier_matching_points) < min_inliers:
+            raise ValueError("Only " + str(len(inlier_matching_points)) + " inliers, the images do not overlap enough")
+
+        stage_time = time.time()
+        stitched = my_stitch(img1, img2, H)
+        if not cv2.imwrite(output_path, stitched):
+            raise OSError("Could not write " + output_path)
+        result['stitch_time'] = time.time() - stage_time
+    except Exception as e:
+        result['status'] = "failed"
+        result['error'] = "".join(traceback.format_exception_only(type(e), e)).strip()
+
+    result['total_time'] = time.time() - start_time
+
+    return result
+
+
+def read_manifest(path, output_dir="."):
+    # Reads a CSV manifest with one pair of images in every line: the path of img1, the path of img2 and, optionally,
+    # the path of the stitched image. Empty lines and lines starting with # are skipped. Relative image paths are
+    # relative to the directory of the manifest; the stitched images without a path are named after their images and
+    # saved in output_dir.
+    # - path: the path of the manifest
+    # - output_dir: the directory of the stitched images without a path
+    # - pairs: list of (img1 path, img2 path, output path) tuples
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    pairs = []
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            if len(row) < 2:
+                raise ValueError("Expected img1,img2[,output] in manifest line: " + ",".join(row))
+
+            img1, img2 = (os.path.join(base_dir, p) for p in row[:2])
+            if len(row) > 2 and row[2]:
+                output = os.path.join(base_dir, row[2])
+            else:
+                name1 = os.path.splitext(os.path.basename(img1))[0]
+                name2 = os.path.splitext(os.path.basename(img2))[0]
+                output = os.path.join(output_dir, name1 + "_" + name2 + "_STITCHED.png")
+            pairs.append((img1, img2, output))
+
+    return pairs
+
+
+def main(argv=None):
+    # Command line entry point. Stitches every pair of the manifest and exits with a non zero status if any pair failed.
+
+    parser = argparse.ArgumentParser(description="Stitch many image pairs in parallel.")
+    parser.add_argument("manifest", help="CSV file with an img1,img2[,output] pair in every line")
+    parser.add_argument("--results", default="results.csv", help="CSV file with the result and timing of every pair")
+    parser.add_argument("--output-dir", default=".", help="directory of the stitched images without an output path")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, all CPUs by default")
+    parser.add_argument("--Rthres", type=float, default=0.15, help="threshold of the Harris detector")
+    parser.add_argument("--r", type=float, default=20, help="inlier distance of RANSAC")
+    parser.add_argument("--N", type=int, default=10000, help="maximum number of RANSAC iterations")
+    parser.add_argument("--ratio", type=float, default=0.8, help="ratio of the nearest neighbour ratio test")
+    parser.add_argument("--min-inliers", type=int, default=10, help="minimum number of RANSAC inliers of a pair")
+    parser.add_argument("--profile", default=None, help="save the time of every stage and the counters, summed over "
+                                                        "all the pairs, to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.profile is not None:
+        instrumentation.enable(args.profile)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    pairs = read_manifest(args.manifest, args.output_dir)
+
+    start_time = time.time()
+    num_failed = stitch_batch(pairs, args.results, args.workers, args.Rthres, args.r, args.N, args.ratio,
+                              args.min_inliers)
+    instrumentation.count("pairs", len(pairs))
+    instrumentation.count("failed_pairs", num_failed)
+    print(len(pairs) - num_failed, "of", len(pairs), "pairs stitched in", time.time() - start_time, "seconds",
+          file=sys.stderr)
+
+    return 1 if num_failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
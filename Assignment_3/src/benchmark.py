@@ -0,0 +1,586 @@
+from helpers import *
+from harrisDetector import *
+from matchDescriptor import *
+from ransac import *
+from imageStitching import *
+from panorama import *
+from batch import *
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def make_pair(img2, angle, shift):
+    # Makes a test pair out of one image: img1 is img2 rotated by angle degrees around its center and shifted by shift
+    # (x, y) pixels. Also returns the exact transform H from img1 to img2, computed from two points.
+    # - img2: the input image
+    # - angle, shift: the rotation and the translation of img1
+    # - img1: the transformed image
+    # - H: dictionary with the rotation angle 'theta' and the translation 'd' that maps img1 to img2
+
+    h, w = img2.shape[:2]
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1)
+    M[:, 2] += shift
+    img1 = cv2.warpAffine(img2, M, (w, h))
+
+    # Two points of img1 and where they come from in img2, as (row, column)
+    M_inv = cv2.invertAffineTransform(M)
+    points1 = np.array([[h / 4, w / 4], [3 * h / 4, 2 * w / 3]])
+    points2 = np.array([np.dot(M_inv, [col, row, 1])[::-1] for row, col in points1])
+    H = calculate_h((points1[0], points2[0]), (points1[1], points2[1]))
+
+    return img1, H
+
+
+def my_stitch_reference(img1, img2, H):
+    # The original per-pixel implementation of my_stitch, benchmark_stitch compares my_stitch with it.
+
+    theta = H['theta']
+    d = H['d']
+
+    # Convert images to double precision
+    img1 = img1.astype(np.float64) / 255.0
+    img2 = img2.astype(np.float64) / 255.0
+
+    # Get image sizes
+    M1, N1, _ = img1.shape
+    M2, N2, _ = img2.shape
+
+    # Define transformation parameters
+    R = np.array([[np.cos(theta), -np.sin(theta)],
+                  [np.sin(theta), np.cos(theta)]])
+
+    # Create stitched image
+    stitched_width = 3 * max(M1, M2)
+    stitched_height = 3 * max(N1, N2)
+
+    stitched = np.zeros((stitched_width, stitched_height, 3))
+
+    # Calculate starting position
+    start = np.ceil([stitched_width / 2, stitched_height / 2]).astype(int)
+
+    # Stitch the images
+    for i in range(start[0], stitched_width):
+        x = i - start[0] + 1
+        for j in range(start[1], stitched_height):
+            y = j - start[1] + 1
+            if x < M1 and y < N1:
+                p = np.ceil(np.dot(R, [x, y]) + d).astype(int)
+                stitched[start[0] + p[0], start[1] + p[1]] = img1[x - 1, y - 1]
+            if x < M2 and y < N2:
+                stitched[i, j] = img2[x - 1, y - 1]
+
+    # Convert image to 8-bit unsigned integer
+    stitched = (stitched * 255).astype(np.uint8)
+
+    return stitched
+
+
+def benchmark_stitch(path, angle=8, shift=(120, -60)):
+    # Compares the time of my_stitch and my_stitch_reference on a pair made from the image, and the size of the tight
+    # canvas with the 3 times larger one of the reference. The reference decides which image ends on top pixel by
+    # pixel, so the position of each image in the canvas is checked separately: img2 alone must be placed exactly,
+    # img1 alone must agree where both canvases are covered.
+    # - path: the path of the image
+    # - angle, shift: the transform of the pair, see make_pair
+
+    img2 = cv2.imread(path)
+    img1, H = make_pair(img2, angle, shift)
+
+    start_time = time.time()
+    stitched = my_stitch(img1, img2, H, tight=False)
+    stitch_time = time.time() - start_time
+
+    start_time = time.time()
+    tight = my_stitch(img1, img2, H)
+    tight_time = time.time() - start_time
+
+    start_time = time.time()
+    reference = my_stitch_reference(img1, img2, H)
+    reference_time = time.time() - start_time
+
+    print(path, ":", img1.shape, "+", img2.shape, "->", stitched.shape)
+    print("my_stitch:", stitch_time, "seconds")
+    print("my_stitch_reference:", reference_time, "seconds")
+    print("my_stitch, tight canvas:", tight_time, "seconds,", tight.shape, tight.nbytes, "bytes instead of",
+          stitched.nbytes)
+    assert stitched.shape == reference.shape
+
+    # Position of img2, with an img1 too small to cover anything
+    empty = np.zeros((2, 2, 3), dtype=np.uint8)
+    assert np.array_equal(my_stitch(empty, img2, H, tight=False), my_stitch_reference(empty, img2, H))
+
+    # Position of img1, with an empty img2
+    empty = np.zeros_like(img2)
+    stitched = my_stitch(img1, empty, H, tight=False)
+    reference = my_stitch_reference(img1, empty, H)
+    covered = np.any(stitched > 0, axis=2) & np.any(reference > 0, axis=2)
+    difference = np.mean(np.abs(stitched.astype(int) - reference.astype(int))[covered])
+    print("img1 mean absolute difference:", difference)
+    assert difference < 2
+
+
+def benchmark_stitch_tiled(path, output_path="stitched.raw", tile_size=256, workers=4, angle=8, shift=(120, -60)):
+    # Compares the time of my_stitch_tiled with my_stitch on a pair made from the image. Both use the same canvas and
+    # the same rounding, so the memory-mapped output must be equal to the stitched image.
+    # - path: the path of the image
+    # - output_path: the path of the memory-mapped output file, which is removed at the end
+    # - tile_size, workers: the parameters of my_stitch_tiled
+    # - angle, shift: the transform of the pair, see make_pair
+
+    img2 = cv2.imread(path)
+    img1, H = make_pair(img2, angle, shift)
+
+    start_time = time.time()
+    stitched = my_stitch(img1, img2, H)
+    stitch_time = time.time() - start_time
+
+    start_time = time.time()
+    tiled = my_stitch_tiled(img1, img2, H, output_path, tile_size, workers)
+    tiled_time = time.time() - start_time
+
+    print(path, ":", img1.shape, "+", img2.shape, "->", tiled.shape)
+    print("my_stitch:", stitch_time, "seconds")
+    print("my_stitch_tiled:", tiled_time, "seconds with", workers, "workers and", tile_size, "x", tile_size, "tiles")
+    assert np.array_equal(np.asarray(tiled), stitched)
+
+    del tiled
+    os.remove(output_path)
+
+
+def benchmark_harris(path, thresholds=(0.6, 0.15, 0.05), min_distance=10):
+    # Times detect_harris_features on the image for a range of thresholds, down to ones that give many thousands of
+    # candidate corners, and checks that no two of the kept corners are closer than min_distance.
+    # - path: the path of the image
+    # - thresholds: the values of Rthres
+    # - min_distance: the minimum distance between two corners
+
+    img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+
+    for Rthres in thresholds:
+        start_time = time.time()
+        corners = detect_harris_features(img, Rthres, min_distance)
+        print("Rthres =", Rthres, ":", len(corners), "corners in", time.time() - start_time, "seconds")
+
+        differences = corners[:, np.newaxis, :] - corners[np.newaxis, :, :]
+        distances = np.sum(differences ** 2, axis=2) + np.eye(len(corners), dtype=int) * min_distance ** 2
+        assert np.all(distances >= min_distance ** 2)
+
+
+def is_corner(img, points, k, Rthres):
+    R = harris_response(img, k)
+
+    # Check if the Harris response is above the threshold for each point
+    return [abs(R[p[0], p[1]]) > Rthres for p in points]
+
+
+def my_detect_harris_features_reference(img, min_distance=10, max_corners=None):
+    # The original implementation of my_detect_harris_features, which tests every interior pixel in a list
+    # comprehension. benchmark_my_harris compares my_detect_harris_features with it.
+
+    k = 0.04  # Harris detector parameter
+    Rthres = 8421000 * float(np.max(img))  # Harris' response threshold
+
+    height, width = img.shape
+
+    # Generate a grid of points for the image
+    grid_y, grid_x = np.mgrid[1:height-1, 1:width-1]
+    points = np.column_stack((grid_y.ravel(), grid_x.ravel()))
+
+    # Evaluate the corner response for all points
+    is_corner_list = is_corner(img, points, k, Rthres)
+
+    # Extract corner coordinates where the response is True
+    corners = points[np.array(is_corner_list)]
+    responses = np.abs(harris_response(img, k)[corners[:, 0], corners[:, 1]])
+
+    # Filter out nearby points, keeping the strongest
+    return suppress_nearby_corners(corners, responses, min_distance, max_corners)
+
+
+def benchmark_my_harris(path, min_distance=10):
+    # Compares the time of my_detect_harris_features with my_detect_harris_features_reference and cv2.cornerHarris, and
+    # counts the corners both custom detectors find. The reference keeps also the pixels that are not local maxima, so
+    # it finds a few more.
+    # - path: the path of the image
+    # - min_distance: the minimum distance between two corners
+
+    img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+
+    start_time = time.time()
+    corners = my_detect_harris_features(img, min_distance)
+    detect_time = time.time() - start_time
+
+    start_time = time.time()
+    reference = my_detect_harris_features_reference(img, min_distance)
+    reference_time = time.time() - start_time
+
+    start_time = time.time()
+    cv2.cornerHarris(img, blockSize=2, ksize=3, k=0.04)
+    opencv_time = time.time() - start_time
+
+    common = set(map(tuple, corners.tolist())) & set(map(tuple, reference.tolist()))
+    print("my_detect_harris_features:", detect_time, "seconds,", len(corners), "corners")
+    print("my_detect_harris_features_reference:", reference_time, "seconds,", len(reference), "corners")
+    print("cv2.cornerHarris:", opencv_time, "seconds")
+    print("Common corners:", len(common))
+
+
+def benchmark_harris_pyramid(path, scale=4, thresholds=(0.6, 0.15), min_distance=10):
+    # Compares the time of detect_harris_features_pyramid with detect_harris_features on the image upscaled to a large
+    # size, and counts how many of the corners of detect_harris_features the pyramid finds too.
+    # - path: the path of the image
+    # - scale: the factor the image is upscaled by
+    # - thresholds: the values of Rthres
+    # - min_distance: the minimum distance between two corners
+
+    img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+    img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    print(path, "upscaled to", img.shape)
+
+    for Rthres in thresholds:
+        start_time = time.time()
+        corners = detect_harris_features(img, Rthres, min_distance)
+        detect_time = time.time() - start_time
+
+        start_time = time.time()
+        pyramid = detect_harris_features_pyramid(img, Rthres, min_distance)
+        pyramid_time = time.time() - start_time
+
+        common = set(map(tuple, corners.tolist())) & set(map(tuple, pyramid.tolist()))
+        print("Rthres =", Rthres)
+        print("detect_harris_features:", detect_time, "seconds,", len(corners), "corners")
+        print("detect_harris_features_pyramid:", pyramid_time, "seconds,", len(pyramid), "corners,", len(common),
+              "in common")
+
+
+def benchmark_descriptor_field(path, rhom=5, rhoM=20, rhostep=0.5, N=8, max_mismatch=0.05):
+    # Compares the descriptors my_local_descriptor_dense looks up in my_local_descriptor_field with my_local_descriptor
+    # at the Harris corners of the image. The field takes every sample at the offset floor(rho * cos) from the point,
+    # while my_local_descriptor rounds p + rho * cos. At the angles where cos or sin is a tiny negative number instead
+    # of zero the scalar version moves one pixel back for points close to the left or top of the image, so at most one
+    # of the N samples of a circle can differ and every value can differ by at most 255 / N. Only a few points may be
+    # affected.
+    # - path: the path of the image
+    # - rhom, rhoM, rhostep, N: the parameters of my_local_descriptor
+    # - max_mismatch: the largest allowed fraction of the points whose descriptors differ
+
+    img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+    points = my_detect_harris_features(img)[:, ::-1]
+
+    start_time = time.time()
+    field = my_local_descriptor_field(img, rhom, rhoM, rhostep, N)
+    descriptors, valid = my_local_descriptor_dense(field, points, rhoM)
+    field_time = time.time() - start_time
+
+    start_time = time.time()
+    reference = [my_local_descriptor(img, point, rhom, rhoM, rhostep, N) for point in points]
+    reference_time = time.time() - start_time
+
+    assert np.array_equal(valid, [len(descriptor) > 0 for descriptor in reference])
+    differences = np.abs(descriptors[valid] - np.array([d for d in reference if d], dtype=np.float64))
+    mismatched = np.count_nonzero(np.any(differences > 1e-3, axis=1))
+
+    print(path, ":", np.count_nonzero(valid), "points,", mismatched, "with different descriptors, max difference",
+          np.max(differences, initial=0))
+    print("my_local_descriptor_field:", field_time, "seconds")
+    print("my_local_descriptor:", reference_time, "seconds")
+    assert np.all(differences <= 255 / N + 1e-3)
+    assert mismatched <= max_mismatch * np.count_nonzero(valid)
+
+
+def benchmark_descriptor_upgrade(path, rhom=5, rhoM=20, rhostep=0.5, N=8, num_bins=8):
+    # Compares the time my_local_descriptor_upgrade_batch and my_local_descriptor_upgrade need for the Harris corners of
+    # the image, in grayscale and in color, and checks that both compute exactly the same histograms.
+    # - path: the path of the image
+    # - rhom, rhoM, rhostep, N, num_bins: the parameters of my_local_descriptor_upgrade
+
+    img = cv2.imread(path)
+    img_g = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    points = my_detect_harris_features(img_g)[:, ::-1]
+
+    for name, image in (("grayscale", img_g), ("color", img)):
+        start_time = time.time()
+        descriptors, valid = my_local_descriptor_upgrade_batch(image, points, rhom, rhoM, rhostep, N, num_bins)
+        batch_time = time.time() - start_time
+
+        start_time = time.time()
+        reference = [my_local_descriptor_upgrade(image, point, rhom, rhoM, rhostep, N, num_bins) for point in points]
+        reference_time = time.time() - start_time
+
+        assert np.array_equal(valid, [len(descriptor) > 0 for descriptor in reference])
+        assert np.array_equal(descriptors[valid], np.array([d for d in reference if d]))
+        assert not np.any(descriptors[~valid])
+
+        print(path, name, ":", np.count_nonzero(valid), "points")
+        print("my_local_descriptor_upgrade_batch:", batch_time, "seconds")
+        print("my_local_descriptor_upgrade:", reference_time, "seconds")
+
+
+def make_matches(num_inliers, num_outliers, H, size=1000, noise=3, seed=0):
+    # Makes a list of matches of (row, column) points: the inliers are random points moved by H plus some noise, the
+    # outliers are pairs of unrelated random points.
+    # - num_inliers, num_outliers: the number of inliers and outliers
+    # - H: dictionary with the rotation angle 'theta' and the translation 'd' of the inliers
+    # - size: the size of the square the points are drawn from
+    # - noise: the maximum noise added to the points of the inliers, in pixels
+    # - seed: the seed of the random number generator
+    # - matching_points: list of the (point of img1, point of img2) matches, with the inliers first
+
+    rng = np.random.default_rng(seed)
+
+    points1 = rng.integers(0, size, (num_inliers + num_outliers, 2))
+    points2 = rng.integers(0, size, (num_inliers + num_outliers, 2))
+    points2[:num_inliers] = transform_points(points1[:num_inliers], H) + \
+        rng.integers(-noise, noise + 1, (num_inliers, 2))
+
+    return list(zip(points1, points2))
+
+
+def my_RANSAC_reference(matching_points, r, N):
+    # The original implementation of my_RANSAC, which scores one hypothesis at a time. benchmark_ransac compares
+    # my_RANSAC with it.
+
+    H = {'theta': 0, 'd': [0, 0]}
+    inlier_matching_points = []
+    outlier_matching_points = []
+    best_distance = []
+
+    score = 0
+
+    for i in range(N):
+        pair1, pair2 = random.sample(matching_points, 2)
+
+        H_temp = calculate_h(pair1, pair2)
+
+        points1 = [pair[0] for pair in matching_points]
+        points2 = [pair[1] for pair in matching_points]
+        transformed_points1 = transform_points(points1, H_temp)
+        transformed_points2 = transform_points(points2, {'theta': 0, 'd': [0, 0]})
+
+        distance = np.linalg.norm(transformed_points2 - transformed_points1, axis=1)
+        count = np.count_nonzero(distance < 80)
+
+        if count > score:
+            score = count
+            best_distance = distance
+            H['theta'] = H_temp['theta']
+            H['d'] = H_temp['d']
+
+    for i in range(len(best_distance)):
+        if best_distance[i] < r:
+            inlier_matching_points.append(matching_points[i])
+        else:
+            outlier_matching_points.append(matching_points[i])
+
+    return H, inlier_matching_points, outlier_matching_points
+
+
+def benchmark_ransac(r=20, N=10000, cases=((60, 140), (300, 700), (200, 1800))):
+    # Compares the time of my_RANSAC and my_RANSAC_reference on random matches with a known transform, and counts how
+    # many of the inliers each one finds.
+    # - r, N: the parameters of my_RANSAC
+    # - cases: the (number of inliers, number of outliers) of every test
+
+    H = {'theta': 0.14, 'd': np.array([-32.5, 43.4])}
+
+    for num_inliers, num_outliers in cases:
+        matching_points = make_matches(num_inliers, num_outliers, H)
+
+        start_time = time.time()
+        _, inliers, _ = my_RANSAC(matching_points, r, N, seed=0)
+        ransac_time = time.time() - start_time
+
+        start_time = time.time()
+        _, reference, _ = my_RANSAC_reference(matching_points, r, N)
+        reference_time = time.time() - start_time
+
+        found = sum(1 for pair in inliers if any(pair is match for match in matching_points[:num_inliers]))
+        reference_found = sum(1 for pair in reference if any(pair is match for match in matching_points[:num_inliers]))
+        print(num_inliers, "inliers,", num_outliers, "outliers")
+        print("my_RANSAC:", ransac_time, "seconds,", found, "inliers found")
+        print("my_RANSAC_reference:", reference_time, "seconds,", reference_found, "inliers found")
+
+
+def benchmark_matching(path, r=20, N=10000, angle=8, shift=(120, -60)):
+    # Compares descriptor_matching with descriptor_matching_ratio on a pair made from the image: the time, the number of
+    # matches and the transform my_RANSAC finds from them, next to the exact one.
+    # - path: the path of the image
+    # - r, N: the parameters of my_RANSAC
+    # - angle, shift: the transform of the pair, see make_pair
+
+    img2 = cv2.imread(path)
+    img1, H = make_pair(img2, angle, shift)
+    img1_g = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    img2_g = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+
+    corners1 = my_detect_harris_features(img1_g)
+    corners2 = my_detect_harris_features(img2_g)
+    print(path, ":", len(corners1), "and", len(corners2), "corners, exact H:", H)
+
+    matchers = {
+        "descriptor_matching": lambda: descriptor_matching(corners1, corners2, img1_g, img2_g, 30, dense=True),
+        "descriptor_matching_ratio": lambda: descriptor_matching_ratio(corners1, corners2, img1_g, img2_g, dense=True),
+        "descriptor_matching_ratio, mutual": lambda: descriptor_matching_ratio(corners1, corners2, img1_g, img2_g,
+                                                                               mutual=True, dense=True),
+    }
+
+    for name, matcher in matchers.items():
+        start_time = time.time()
+        matching_points = matcher()
+        matching_time = time.time() - start_time
+
+        H_found, inliers, _ = my_RANSAC(matching_points, r, N, seed=0)
+        print(name, ":", matching_time, "seconds,", len(matching_points), "matches,", len(inliers), "inliers, H:",
+              H_found)
+
+
+def benchmark_panorama(path, num_views=(2, 3, 5), overlap=150):
+    # Cuts the image into overlapping vertical strips and times my_panorama on them, to check that the time grows
+    # linearly with the number of images and that the panorama rebuilds the image. Each run is repeated with the
+    # features already in the cache.
+    # - path: the path of the image
+    # - num_views: the numbers of strips
+    # - overlap: the number of columns that neighbouring strips share
+
+    img = cv2.imread(path)
+    width = img.shape[1]
+
+    for n in num_views:
+        step = (width - overlap) // n
+        views = [img[:, i * step:min((i + 1) * step + overlap, width)] for i in range(n)]
+
+        cache = {}
+        start_time = time.time()
+        panorama, _ = my_panorama(views, cache=cache)
+        panorama_time = time.time() - start_time
+
+        start_time = time.time()
+        my_panorama(views, cache=cache)
+        cached_time = time.time() - start_time
+
+        print(n, "images:", panorama_time, "seconds,", cached_time, "seconds with cached features,", panorama.shape)
+        if panorama.shape == img[:, :panorama.shape[1]].shape:
+            difference = np.mean(np.abs(panorama.astype(int) - img[:, :panorama.shape[1]].astype(int)))
+            print("Mean absolute difference from the image:", difference)
+
+
+def benchmark_batch(path, workers=2, overlap=0.6):
+    # Runs stitch_batch on pairs made from the left and right parts of the image: one pair that overlaps and is stitched
+    # and one pair that does not overlap and must be reported as failed instead of stitched with a random transform.
+    # - path: the path of the image
+    # - workers: the number of worker processes
+    # - overlap: the width of each part of the overlapping pair, as a fraction of the width of the image
+
+    img = cv2.imread(path)
+    w = img.shape[1]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        parts = {"left": img[:, :int(w * overlap)], "right": img[:, int(w * (1 - overlap)):],
+                 "left_third": img[:, :w // 3], "right_third": img[:, 2 * w // 3:]}
+        for name, part in parts.items():
+            cv2.imwrite(os.path.join(tmp_dir, name + ".png"), part)
+
+        pairs = [(os.path.join(tmp_dir, name1 + ".png"), os.path.join(tmp_dir, name2 + ".png"),
+                  os.path.join(tmp_dir, name1 + "_" + name2 + ".png"))
+                 for name1, name2 in (("left", "right"), ("left_third", "right_third"))]
+        results_path = os.path.join(tmp_dir, "results.csv")
+
+        start_time = time.time()
+        num_failed = stitch_batch(pairs, results_path, workers)
+        print(len(pairs), "pairs in", time.time() - start_time, "seconds,", num_failed, "failed")
+
+        with open(results_path, newline="") as f:
+            results = {os.path.basename(row['output']): row for row in csv.DictReader(f)}
+        for name, row in results.items():
+            print(name, ":", row['status'], row['inliers'], "inliers", row['error'])
+
+        assert results["left_right.png"]['status'] == "ok"
+        assert results["left_third_right_third.png"]['status'] == "failed"
+        assert not os.path.exists(os.path.join(tmp_dir, "left_third_right_third.png"))
+
+
+def make_sequence(img, num_frames, size=(400, 500), step=(8, 15), angle=0.3):
+    # Makes a video-like sequence out of one image: a window that slides and turns a little more in every frame.
+    # - img: the input image
+    # - num_frames: the number of frames
+    # - size: the (rows, columns) of the frames
+    # - step: the (row, column) shift of the window in every frame
+    # - angle: the rotation of the window in every frame, in degrees
+    # - frames: the list of the frames
+    # - transforms: the exact transform H of every frame to the first frame
+
+    height, width = size
+    matrices = []
+    for k in range(num_frames):
+        M = cv2.getRotationMatrix2D((width / 2, height / 2), angle * k, 1)
+        M[:, 2] += [40 + step[1] * k, 50 + step[0] * k]
+        matrices.append(np.vstack((M, [0, 0, 1])))
+
+    frames = [cv2.warpAffine(img, M[:2], (width, height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+              for M in matrices]
+
+    # The frame pixel (x, y) is the image pixel M (x, y); move it into the first frame and turn it into an H of
+    # (row, column) points
+    transforms = []
+    for M in matrices:
+        A = np.dot(np.linalg.inv(matrices[0]), M)
+        transforms.append({'theta': np.arctan2(A[0, 1], A[0, 0]), 'd': A[[1, 0], 2]})
+
+    return frames, transforms
+
+
+def benchmark_tracking(path, num_frames=30):
+    # Compares the time per frame of track_frames with detecting and matching the corners of every frame, on a
+    # sequence made from the image, and measures how far the tracked transforms drift from the exact ones.
+    # - path: the path of the image
+    # - num_frames: the number of frames of the sequence
+
+    frames, transforms = make_sequence(cv2.imread(path), num_frames)
+
+    start_time = time.time()
+    tracked = list(track_frames(frames))
+    tracking_time = (time.time() - start_time) / num_frames
+
+    start_time = time.time()
+    features = [get_image_features(frame, 0.15) for frame in frames]
+    for features1, features2 in zip(features[1:], features[:-1]):
+        indices1, indices2 = match_descriptors_ratio(features1['descriptors'], features1['valid'],
+                                                     features2['descriptors'], features2['valid'])
+        my_RANSAC([(features1['corners'][i], features2['corners'][j]) for i, j in zip(indices1, indices2)], 5, 1000)
+    matching_time = (time.time() - start_time) / num_frames
+
+    # Largest error of the corners of the frames in the first frame
+    corners = np.array([[0, 0], [0, 499], [399, 0], [399, 499]], dtype=np.float64)
+    error = max(np.max(np.abs(transform_points_exact(corners, H) - transform_points_exact(corners, H_exact)))
+                for H, H_exact in zip(tracked, transforms))
+
+    print(num_frames, "frames of", frames[0].shape)
+    print("track_frames:", tracking_time, "seconds per frame, largest error", error, "pixels")
+    print("detection and matching:", matching_time, "seconds per frame")
+
+
+if __name__ == "__main__":
+    benchmarks = {
+        "stitch": lambda: benchmark_stitch("im2.png"),
+        "stitch_tiled": lambda: benchmark_stitch_tiled("im2.png"),
+        "harris": lambda: benchmark_harris("im2.png"),
+        "my_harris": lambda: benchmark_my_harris("im2.png"),
+        "harris_pyramid": lambda: benchmark_harris_pyramid("im2.png"),
+        "descriptor_field": lambda: benchmark_descriptor_field("im2.png"),
+        "descriptor_upgrade": lambda: benchmark_descriptor_upgrade("im2.png"),
+        "ransac": benchmark_ransac,
+        "matching": lambda: benchmark_matching("im2.png"),
+        "panorama": lambda: benchmark_panorama("im2.png"),
+        "batch": lambda: benchmark_batch("im2.png"),
+        "tracking": lambda: benchmark_tracking("im2.png"),
+    }
+
+    for name in sys.argv[1:] or benchmarks:
+        print("--------------------")
+        print(name)
+        print("--------------------")
+        benchmarks[name]()
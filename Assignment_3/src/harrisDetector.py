@@ -1,11 +1,21 @@
 import cv2
 import numpy as np
+import instrumentation
 
 
-def is_corner(img, points, k, Rthres):
+def harris_response(img, k, dtype=np.float64, sigma=None):
+    # Computes the Harris response of every pixel of the image.
+    # - img: the grayscale image
+    # - k: Harris detector parameter
+    # - dtype: np.float64 or np.float32, the precision of the computation
+    # - sigma: the standard deviation of a Gaussian window; if it is None the derivatives are summed in a 3x3 box
+    # - R: the response map, of the same size as the image
+
+    depth = cv2.CV_32F if dtype == np.float32 else cv2.CV_64F
+
     # Calculate image derivatives
-    dx = cv2.Sobel(img, cv2.CV_64F, 1, 0, ksize=3)
-    dy = cv2.Sobel(img, cv2.CV_64F, 0, 1, ksize=3)
+    dx = cv2.Sobel(img, depth, 1, 0, ksize=3)
+    dy = cv2.Sobel(img, depth, 0, 1, ksize=3)
 
     # Calculate products of derivatives
     dxx = dx * dx
@@ -13,46 +23,54 @@ def is_corner(img, points, k, Rthres):
     dxy = dx * dy
 
     # Calculate sums of derivatives within the neighborhood
-    dxx_sum = cv2.boxFilter(dxx, cv2.CV_64F, (3, 3))
-    dyy_sum = cv2.boxFilter(dyy, cv2.CV_64F, (3, 3))
-    dxy_sum = cv2.boxFilter(dxy, cv2.CV_64F, (3, 3))
+    if sigma is None:
+        dxx_sum = cv2.boxFilter(dxx, depth, (3, 3))
+        dyy_sum = cv2.boxFilter(dyy, depth, (3, 3))
+        dxy_sum = cv2.boxFilter(dxy, depth, (3, 3))
+    else:
+        dxx_sum = cv2.GaussianBlur(dxx, (0, 0), sigma)
+        dyy_sum = cv2.GaussianBlur(dyy, (0, 0), sigma)
+        dxy_sum = cv2.GaussianBlur(dxy, (0, 0), sigma)
 
     # Calculate Harris response
     det = dxx_sum * dyy_sum - dxy_sum * dxy_sum
     trace = dxx_sum + dyy_sum
     R = det - k * (trace ** 2)
 
-    # Check if the Harris response is above the threshold for each point
-    return [abs(R[p[0], p[1]]) > Rthres for p in points]
-
+    return R
 
-def my_detect_harris_features(img, min_distance=10):
-    k = 0.04  # Harris detector parameter
-    Rthres = 8421000 * np.max(img)  # Harris' response threshold
 
-    height, width = img.shape
+@instrumentation.timed("harris")
+def my_detect_harris_features(img, min_distance=10, max_corners=None, sigma=None):
+    # Detects the corners of a grayscale image with the Harris response of harris_response. The candidates are the
+    # interior pixels whose absolute response is over the threshold and is the maximum of their 3x3 neighbourhood,
+    # found with one dilation of the response map, and are then filtered with suppress_nearby_corners.
+    # - img: the grayscale image
+    # - min_distance, max_corners: the parameters of suppress_nearby_corners
+    # - sigma: the standard deviation of a Gaussian window, the 3x3 box window is used if it is None
+    # - corners: array of the (row, column) corners, from the strongest to the weakest
 
-    # Generate a grid of points for the image
-    grid_y, grid_x = np.mgrid[1:height-1, 1:width-1]
-    points = np.column_stack((grid_y.ravel(), grid_x.ravel()))
+    k = 0.04  # Harris detector parameter
+    Rthres = 8421000 * float(np.max(img))  # Harris' response threshold
 
     # Evaluate the corner response for all points
-    is_corner_list = is_corner(img, points, k, Rthres)
+    response = np.abs(harris_response(img, k, np.float32, sigma))
 
-    # Extract corner coordinates where the response is True
-    corners = points[np.array(is_corner_list)]
+    # Keep the local maxima over the threshold, away from the image boundary
+    mask = (response > Rthres) & (response == cv2.dilate(response, None))
+    mask[[0, -1], :] = False
+    mask[:, [0, -1]] = False
 
-    # Filter out nearby points
-    filtered_corners = []
-    for corner in corners:
-        if not any(np.linalg.norm(corner - filtered_corner) < min_distance for filtered_corner in filtered_corners):
-            filtered_corners.append(corner)
+    # Extract corner coordinates where the response is True
+    corners = np.argwhere(mask)
+    responses = response[mask]
 
-    # Return the coordinates of the corners
-    return np.array(filtered_corners)
+    # Filter out nearby points, keeping the strongest
+    return suppress_nearby_corners(corners, responses, min_distance, max_corners)
 
 
-def detect_harris_features(img, Rthres, min_distance=10):
+@instrumentation.timed("harris")
+def detect_harris_features(img, Rthres, min_distance=10, max_corners=None):
     # Convert image to grayscale if it's not already
     if len(img.shape) == 3:
         img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -60,18 +78,148 @@ def detect_harris_features(img, Rthres, min_distance=10):
         img_gray = img
 
     # Apply Harris corner detection
-    corners = cv2.cornerHarris(img_gray, blockSize=2, ksize=3, k=0.04)
-    corners = cv2.dilate(corners, None)
+    response = cv2.cornerHarris(img_gray, blockSize=2, ksize=3, k=0.04)
+    corners = cv2.dilate(response, None)
 
     # Set a threshold to select strong corners
     threshold = Rthres * corners.max()
     corners = np.argwhere(corners > threshold)
 
-    # Filter out nearby points
+    # Filter out nearby points, keeping the strongest
+    return suppress_nearby_corners(corners, response[corners[:, 0], corners[:, 1]], min_distance, max_corners)
+
+
+def suppress_nearby_corners(corners, responses, min_distance=10, max_corners=None):
+    # Keeps the corners that have no stronger corner closer than min_distance. The corners are visited from the
+    # strongest to the weakest (ties in the order they are given), and every kept corner is stored in a grid of cells
+    # of size min_distance, so each corner is only compared with the kept corners of the 3x3 cells around it instead
+    # of all of them.
+    # - corners: array of (row, column) candidate corners
+    # - responses: the corner response of every candidate
+    # - min_distance: the minimum distance between two kept corners
+    # - max_corners: the maximum number of corners to keep, all of them are kept if it is None
+    # - filtered_corners: array of the kept (row, column) corners, from the strongest to the weakest
+
+    corners = np.asarray(corners).reshape(-1, 2)
+    order = np.argsort(-np.asarray(responses), kind='stable')
+
+    if max_corners is None:
+        max_corners = len(corners)
+
+    cell_size = max(min_distance, 1)
+    cells = (corners // cell_size).astype(int).tolist()
+    points = corners.tolist()
+
+    grid = {}
     filtered_corners = []
-    for corner in corners:
-        if not any(np.linalg.norm(corner - filtered_corner) < min_distance for filtered_corner in filtered_corners):
-            filtered_corners.append(corner)
+    for i in order:
+        if len(filtered_corners) >= max_corners:
+            break
+
+        row, col = points[i]
+        cell_row, cell_col = cells[i]
+        if any((row - other[0]) ** 2 + (col - other[1]) ** 2 < min_distance ** 2
+               for r in (cell_row - 1, cell_row, cell_row + 1)
+               for c in (cell_col - 1, cell_col, cell_col + 1)
+               for other in grid.get((r, c), ())):
+            continue
+
+        grid.setdefault((cell_row, cell_col), []).append((row, col))
+        filtered_corners.append(i)
+
+    instrumentation.count("corners", len(filtered_corners))
 
     # Return the coordinates of the corners
-    return np.array(filtered_corners)
+    return corners[filtered_corners]
+
+
+@instrumentation.timed("harris")
+def detect_harris_features_pyramid(img, Rthres, min_distance=10, max_corners=None, levels=1, coarse_Rthres=None,
+                                   block_size=16, max_refined=0.5):
+    # Works like detect_harris_features, but the response is first computed on an image downsampled levels times with
+    # cv2.pyrDown. The full resolution response is then computed only in the blocks of block_size x block_size coarse
+    # pixels that contain a coarse candidate, so the cost depends on the number of candidates more than on the size of
+    # the image. The threshold of each level is relative to the strongest response found in that level. When the
+    # candidates are spread over most of the image, refining their blocks one run at a time is slower than a single
+    # full resolution pass, so the result of detect_harris_features is returned instead.
+    # - img: the input image
+    # - Rthres: the threshold of the full resolution response, relative to its maximum
+    # - min_distance, max_corners: the parameters of suppress_nearby_corners
+    # - levels: the number of times the image is downsampled
+    # - coarse_Rthres: the threshold of the coarse response, relative to its maximum; it is lower than Rthres by
+    # default, since downsampling weakens small corners
+    # - block_size: the size of the refined blocks in coarse pixels; the neighbouring blocks of a row are refined
+    # together
+    # - max_refined: the largest fraction of the blocks that is refined; detect_harris_features is used above it
+    # - corners: array of the (row, column) corners, from the strongest to the weakest
+
+    # Convert image to grayscale if it's not already
+    if len(img.shape) == 3:
+        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    else:
+        img_gray = img
+
+    if coarse_Rthres is None:
+        coarse_Rthres = Rthres / 4
+
+    # Detect the candidates on the coarse level
+    coarse = img_gray
+    for _ in range(levels):
+        coarse = cv2.pyrDown(coarse)
+    scale = 2 ** levels
+
+    response = cv2.dilate(cv2.cornerHarris(coarse, blockSize=2, ksize=3, k=0.04), None)
+    candidates = response > coarse_Rthres * response.max()
+
+    # Mark the blocks that contain a candidate, padding the coarse level to a whole number of blocks
+    coarse_height, coarse_width = coarse.shape
+    block_rows, block_cols = -(-coarse_height // block_size), -(-coarse_width // block_size)
+    padded = np.zeros((block_rows * block_size, block_cols * block_size), dtype=bool)
+    padded[:coarse_height, :coarse_width] = candidates
+    has_candidate = padded.reshape(block_rows, block_size, block_cols, block_size).any(axis=(1, 3))
+
+    if np.count_nonzero(has_candidate) > max_refined * has_candidate.size:
+        return detect_harris_features(img_gray, Rthres, min_distance, max_corners)
+
+    # Refine the blocks with candidates at full resolution, with a margin for the derivatives and the dilation
+    height, width = img_gray.shape
+    size = block_size * scale
+    margin = 4
+    blocks = np.argwhere(has_candidate)
+
+    # Merge the neighbouring blocks of each row into runs, so that each run is refined with a single call
+    run_starts = np.ones(len(blocks), dtype=bool)
+    run_starts[1:] = (blocks[1:, 0] != blocks[:-1, 0]) | (blocks[1:, 1] != blocks[:-1, 1] + 1)
+    run_ends = np.ones(len(blocks), dtype=bool)
+    run_ends[:-1] = run_starts[1:]
+    runs = np.column_stack((blocks[run_starts], blocks[run_ends, 1]))
+
+    windows = []
+    for block_row, first_col, last_col in runs:
+        top, left = block_row * size, first_col * size
+        bottom, right = min(top + size, height), min((last_col + 1) * size, width)
+        top0, left0 = max(top - margin, 0), max(left - margin, 0)
+
+        window = img_gray[top0:min(bottom + margin, height), left0:min(right + margin, width)]
+        window_response = cv2.cornerHarris(window, blockSize=2, ksize=3, k=0.04)
+        window_dilated = cv2.dilate(window_response, None)
+
+        # Keep the pixels of the block itself, not of its margin
+        inner = (slice(top - top0, bottom - top0), slice(left - left0, right - left0))
+        windows.append((top, left, window_response[inner], window_dilated[inner]))
+
+    if len(windows) == 0:
+        return np.empty((0, 2), dtype=int)
+
+    # Set a threshold to select strong corners
+    threshold = Rthres * max(window_dilated.max() for _, _, _, window_dilated in windows)
+
+    corners = []
+    responses = []
+    for top, left, window_response, window_dilated in windows:
+        block_corners = np.argwhere(window_dilated > threshold)
+        corners.append(block_corners + [top, left])
+        responses.append(window_response[block_corners[:, 0], block_corners[:, 1]])
+
+    # Filter out nearby points, keeping the strongest
+    return suppress_nearby_corners(np.concatenate(corners), np.concatenate(responses), min_distance, max_corners)
@@ -1,45 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor
+import cv2
 import numpy as np
+import instrumentation
 
 
-def my_stitch(img1, img2, H):
+@instrumentation.timed("stitch")
+def my_stitch(img1, img2, H, tight=True, dtype=np.uint8):
+    # Stitches img1 onto img2 with the rigid transform H, which maps the (row, column) points of img1 to img2. Instead
+    # of visiting every pixel of the canvas, img1 is warped with a single cv2.warpAffine, which maps every canvas pixel
+    # back into img1, and img2 is copied over it with array slicing. The canvas is the bounding box of both images
+    # under H, so its size follows the area of the panorama, and the images stay in uint8 unless float32 is asked for.
+    # - img1, img2: the input images
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the transform
+    # - tight: if False the canvas is 3 times the size of the largest image, with img2 in the middle, as in the original
+    # per-pixel implementation
+    # - dtype: np.uint8, or np.float32 for an output scaled to [0, 1]
+    # - stitched: the stitched image
 
-    theta = H['theta']
-    d = H['d']
-
-    # Convert images to double precision
-    img1 = img1.astype(np.float64) / 255.0
-    img2 = img2.astype(np.float64) / 255.0
+    if dtype == np.float32:
+        img1 = img1.astype(np.float32) / 255
+        img2 = img2.astype(np.float32) / 255
+    elif dtype != np.uint8:
+        raise ValueError("Unsupported stitching data type: " + str(dtype))
 
     # Get image sizes
-    M1, N1, _ = img1.shape
-    M2, N2, _ = img2.shape
+    M2, N2 = img2.shape[:2]
+
+    # Get the canvas and the position of img2 in it
+    if tight:
+        start, (stitched_width, stitched_height) = get_stitch_canvas(img1.shape, img2.shape, H)
+    else:
+        stitched_width = 3 * max(img1.shape[0], M2)
+        stitched_height = 3 * max(img1.shape[1], N2)
+        start = np.ceil([stitched_width / 2, stitched_height / 2]).astype(int)
+
+    # Warp img1 into the canvas
+    A = get_affine_matrix(H, start)
+    stitched = cv2.warpAffine(img1, A, (stitched_height, stitched_width), flags=cv2.INTER_NEAREST,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    # Copy img2 on top of it
+    stitched[start[0]:start[0] + M2 - 1, start[1]:start[1] + N2 - 1] = img2[:M2 - 1, :N2 - 1]
+    instrumentation.count("canvas_bytes", stitched.nbytes)
+
+    return stitched
+
+
+@instrumentation.timed("stitch")
+def my_stitch_tiled(img1, img2, H, path, tile_size=1024, workers=4, dtype=np.uint8):
+    # Works like my_stitch with the tight canvas, but writes the stitched image to a memory-mapped file tile by tile, so
+    # that it does not have to fit in memory. Each tile warps only the rows and columns of img1 that its corners map
+    # back to, so img1 and img2 can themselves be memory-mapped (e.g. with np.load(..., mmap_mode='r')) and are only
+    # read where they are needed. The tiles are processed by a pool of threads, since cv2.warpAffine releases the GIL,
+    # and the memory used at any time is about workers times the size of a tile and of its part of img1.
+    # - img1, img2: the input images
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the transform
+    # - path: the path of the raw output file
+    # - tile_size: the number of rows and columns of a tile
+    # - workers: the number of threads
+    # - dtype: np.uint8, or np.float32 for an output scaled to [0, 1]
+    # - stitched: the stitched image, as an np.memmap of the output file
+
+    if dtype != np.uint8 and dtype != np.float32:
+        raise ValueError("Unsupported stitching data type: " + str(dtype))
+
+    start, size = get_stitch_canvas(img1.shape, img2.shape, H)
+    A = get_affine_matrix(H, start)
+
+    stitched = np.memmap(path, dtype=dtype, mode='w+', shape=tuple(size) + img1.shape[2:])
+    instrumentation.count("canvas_bytes", stitched.nbytes)
+
+    tiles = [(row, col, min(row + tile_size, size[0]), min(col + tile_size, size[1]))
+             for row in range(0, size[0], tile_size) for col in range(0, size[1], tile_size)]
+
+    def stitch_tile(bounds):
+        row0, col0, row1, col1 = bounds
+        stitched[row0:row1, col0:col1] = get_stitched_tile(img1, img2, A, start, bounds, dtype)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(stitch_tile, tiles))
+
+    stitched.flush()
+
+    return stitched
+
+
+def get_stitched_tile(img1, img2, A, start, bounds, dtype=np.uint8):
+    # Computes one tile of the stitched image: the part of img1 that the tile covers is cut out and warped with the
+    # affine matrix moved to the tile, then the part of img2 in the tile is copied on top of it.
+    # - img1, img2: the input images
+    # - A: the affine matrix of get_affine_matrix
+    # - start: (row, column) position of the origin of img2 in the canvas
+    # - bounds: (first row, first column, last row + 1, last column + 1) of the tile in the canvas
+    # - dtype: np.uint8, or np.float32 for a tile scaled to [0, 1]
+    # - tile: the pixels of the tile
+
+    row0, col0, row1, col1 = bounds
+    M1, N1 = img1.shape[:2]
+    M2, N2 = img2.shape[:2]
+
+    tile = np.zeros((row1 - row0, col1 - col0) + img1.shape[2:], dtype=dtype)
+
+    # Map the corners of the tile back into img1, with a pixel of margin for the rounding, as (x, y) = (column, row)
+    A_inv = cv2.invertAffineTransform(A)
+    corners = np.array([[col0, row0, 1], [col1, row0, 1], [col0, row1, 1], [col1, row1, 1]], dtype=np.float64)
+    footprint = np.dot(corners, A_inv.T)
+    x0, y0 = np.maximum(np.floor(np.min(footprint, axis=0)).astype(int) - 1, 0)
+    x1 = min(int(np.ceil(np.max(footprint[:, 0]))) + 2, N1)
+    y1 = min(int(np.ceil(np.max(footprint[:, 1]))) + 2, M1)
+
+    # Warp the part of img1 in the footprint into the tile
+    if x0 < x1 and y0 < y1:
+        source = np.ascontiguousarray(img1[y0:y1, x0:x1])
+        if dtype == np.float32:
+            source = source.astype(np.float32) / 255
+        A_tile = A.copy()
+        A_tile[:, 2] += np.dot(A[:, :2], [x0, y0]) - [col0, row0]
+        tile = cv2.warpAffine(source, A_tile, (col1 - col0, row1 - row0), dst=tile, flags=cv2.INTER_NEAREST,
+                              borderMode=cv2.BORDER_TRANSPARENT)
+
+    # Copy the part of img2 in the tile on top of it
+    top, left = max(row0, start[0]), max(col0, start[1])
+    bottom, right = min(row1, start[0] + M2 - 1), min(col1, start[1] + N2 - 1)
+    if top < bottom and left < right:
+        source = img2[top - start[0]:bottom - start[0], left - start[1]:right - start[1]]
+        tile[top - row0:bottom - row0, left - col0:right - col0] = \
+            source.astype(np.float32) / 255 if dtype == np.float32 else source
+
+    return tile
+
+
+def get_stitch_canvas(shape1, shape2, H):
+    # Finds the smallest canvas that holds both images: the bounding box of the corners of img1 moved by H, in the same
+    # way as get_affine_matrix places them, and of img2, which is not moved.
+    # - shape1, shape2: the shapes of img1 and img2
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the transform
+    # - start: (row, column) position of the origin of img2 in the canvas
+    # - size: (rows, columns) of the canvas
+
+    theta = H['theta']
+    d = np.asarray(H['d'], dtype=np.float64)
 
-    # Define transformation parameters
     R = np.array([[np.cos(theta), -np.sin(theta)],
                   [np.sin(theta), np.cos(theta)]])
 
-    # Create stitched image
-    stitched_width = 3 * max(M1, M2)
-    stitched_height = 3 * max(N1, N2)
+    M1, N1 = shape1[:2]
+    M2, N2 = shape2[:2]
 
-    stitched = np.zeros((stitched_width, stitched_height, 3))
+    # Canvas position of the corners of img1 and of the part of img2 that my_stitch copies
+    corners1 = np.array([[0, 0], [0, N1 - 1], [M1 - 1, 0], [M1 - 1, N1 - 1]]) + 1
+    corners1 = np.floor(np.dot(corners1, R.T) + d + 0.5)
+    corners2 = np.array([[0, 0], [M2 - 2, N2 - 2]])
+    corners = np.vstack((corners1, corners2))
 
-    # Calculate starting position
-    start = np.ceil([stitched_width / 2, stitched_height / 2]).astype(int)
+    top_left = np.min(corners, axis=0).astype(int)
+    bottom_right = np.max(corners, axis=0).astype(int)
 
-    # Stitch the images
-    for i in range(start[0], stitched_width):
-        x = i - start[0] + 1
-        for j in range(start[1], stitched_height):
-            y = j - start[1] + 1
-            if x < M1 and y < N1:
-                p = np.ceil(np.dot(R, [x, y]) + d).astype(int)
-                stitched[start[0] + p[0], start[1] + p[1]] = img1[x - 1, y - 1]
-            if x < M2 and y < N2:
-                stitched[i, j] = img2[x - 1, y - 1]
+    start = -top_left
+    size = tuple(bottom_right - top_left + 1)
 
-    # Convert image to 8-bit unsigned integer
-    stitched = (stitched * 255).astype(np.uint8)
+    return start, size
 
-    return stitched
 
+def get_affine_matrix(H, offset):
+    # Builds the 2x3 matrix of cv2.warpAffine that moves img1 into a canvas where img2 starts at offset. Like the
+    # original per-pixel implementation, the pixel q = (row, column) of img1 is placed at offset + ceil(R (q + 1) + d);
+    # the ceil is approximated by adding half a pixel before the nearest-neighbour rounding. cv2 works with
+    # (x, y) = (column, row) points, so the rows and the columns of the transform are swapped.
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the transform
+    # - offset: (row, column) position of the origin of img2 in the canvas
+    # - A: the 2x3 affine matrix
+
+    theta = H['theta']
+    d = np.asarray(H['d'], dtype=np.float64)
+
+    R = np.array([[np.cos(theta), -np.sin(theta)],
+                  [np.sin(theta), np.cos(theta)]])
+
+    # (row, column) translation
+    t = np.dot(R, [1, 1]) + d + np.asarray(offset) + 0.5
+
+    A = np.array([[R[1, 1], R[1, 0], t[1]],
+                  [R[0, 1], R[0, 0], t[0]]])
+
+    return A
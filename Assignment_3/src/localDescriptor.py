@@ -68,3 +68,103 @@ def my_local_descriptor_upgrade(img, p, rhom, rhoM, rhostep, N, num_bins):
 
     return descriptor
 
+
+def my_local_descriptor_field(img, rhom, rhoM, rhostep, N):
+    # Computes my_local_descriptor for every pixel of the image at once. The mean of the N samples on the circle of
+    # radius rho around a pixel is a correlation of the image with a ring kernel that has weight 1/N at the offset of
+    # every sample. The ring kernels have only N non-zero weights, so each correlation is computed as the sum of N
+    # shifted copies of the image.
+    # - img: the input image
+    # - rhom, rhoM, rhostep, N: the parameters of my_local_descriptor
+    # - field: (number of circles, height, width) float32 array; field[:, y, x] is the descriptor of the point [x, y]
+
+    radii = np.arange(rhom, rhoM, rhostep)
+    size = int(np.ceil(rhoM))
+    h, w = img.shape[:2]
+
+    # my_local_descriptor averages over the channels too
+    img = img.astype(np.float32)
+    if img.ndim == 3:
+        img = np.mean(img, axis=2)
+    padded = np.pad(img, size, mode='constant')
+
+    field = np.zeros((len(radii), h, w), dtype=np.float32)
+    angles = 2 * np.pi * np.arange(N) / N
+
+    for k, rho in enumerate(radii):
+        # The samples of my_local_descriptor are at int(p + rho * cos), which is p + floor(rho * cos) for p >= rhoM.
+        # The rounding drops the error of cos and sin, which disappears when it is added to p.
+        dx = np.floor(np.round(rho * np.cos(angles), 9)).astype(int)
+        dy = np.floor(np.round(rho * np.sin(angles), 9)).astype(int)
+        for i in range(N):
+            field[k] += padded[size + dy[i]:size + dy[i] + h, size + dx[i]:size + dx[i] + w]
+        field[k] /= N
+
+    return field
+
+
+def my_local_descriptor_dense(field, points, rhoM):
+    # Looks up the descriptors of many points in a field computed by my_local_descriptor_field.
+    # - field: the output of my_local_descriptor_field
+    # - points: array of [x, y] points
+    # - rhoM: the radius of the outer circle, points closer than rhoM to the boundary have no descriptor
+    # - descriptors: (number of points, number of circles) array with the descriptor of each point in each row; the
+    # rows of the points that are too close to the boundary are zero
+    # - valid: boolean array that is True for the points that have a descriptor
+
+    h, w = field.shape[1:]
+    points = np.asarray(points, dtype=int).reshape(-1, 2)
+    x, y = points[:, 0], points[:, 1]
+    valid = (x - rhoM >= 0) & (x + rhoM < w) & (y - rhoM >= 0) & (y + rhoM < h)
+
+    descriptors = np.zeros((len(points), field.shape[0]), dtype=field.dtype)
+    descriptors[valid] = field[:, y[valid], x[valid]].T
+
+    return descriptors, valid
+
+
+def my_local_descriptor_upgrade_batch(img, points, rhom, rhoM, rhostep, N, num_bins):
+    # Computes my_local_descriptor_upgrade for many points at once. The sample coordinates of every point, circle and
+    # angle are computed with the same arithmetic as the scalar version and all the samples are gathered with one fancy
+    # index, since getRectSubPix at integer coordinates returns the pixel itself. The histograms of every point and
+    # circle are then counted with a single np.bincount over the flattened (point, circle, bin) indices.
+    # - img: the input image
+    # - points: array of [x, y] points
+    # - rhom, rhoM, rhostep, N, num_bins: the parameters of my_local_descriptor_upgrade
+    # - descriptors: (number of points, number of circles * num_bins) array with the descriptor of each point in each
+    # row; the rows of the points that are too close to the boundary are zero
+    # - valid: boolean array that is True for the points that have a descriptor
+
+    h, w = img.shape[:2]
+    points = np.asarray(points).reshape(-1, 2)
+    valid = (points[:, 0] - rhoM >= 0) & (points[:, 0] + rhoM < w) & \
+            (points[:, 1] - rhoM >= 0) & (points[:, 1] + rhoM < h)
+
+    radii = np.arange(rhom, rhoM, rhostep)
+    num_bins = int(num_bins)
+    descriptors = np.zeros((len(points), len(radii) * num_bins))
+
+    valid_points = points[valid]
+    if len(valid_points) == 0 or len(radii) == 0:
+        return descriptors, valid
+
+    # Sample coordinates, (points, circles, angles)
+    angles = 2 * np.pi * np.arange(N) / N
+    x = (valid_points[:, 0, np.newaxis, np.newaxis] + radii[:, np.newaxis] * np.cos(angles)).astype(int)
+    y = (valid_points[:, 1, np.newaxis, np.newaxis] + radii[:, np.newaxis] * np.sin(angles)).astype(int)
+
+    samples = img[y, x]
+    if samples.ndim == 4:
+        samples = np.mean(samples, axis=3)  # the scalar version averages over the channels
+    else:
+        samples = samples.astype(np.float64)
+    bin_index = (samples / 255 * (num_bins - 1)).astype(int)
+
+    # Flattened (point, circle, bin) index of every sample
+    histogram_index = np.arange(len(valid_points) * len(radii)).reshape(len(valid_points), len(radii), 1)
+    flat_index = histogram_index * num_bins + bin_index
+    counts = np.bincount(flat_index.ravel(), minlength=len(valid_points) * len(radii) * num_bins)
+
+    descriptors[valid] = counts.reshape(len(valid_points), len(radii) * num_bins)
+
+    return descriptors, valid
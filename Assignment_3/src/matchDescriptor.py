@@ -1,31 +1,122 @@
 from localDescriptor import *
+from scipy.spatial import cKDTree
+import instrumentation
 
 
-def descriptor_matching(points1, points2, img1, img2, percentageThreshold):
+@instrumentation.timed("matching")
+def descriptor_matching(points1, points2, img1, img2, percentageThreshold, dense=False):
+    # Computes the local descriptor of every point of both images once, then the Euclidean distances between all the
+    # pairs of descriptors with a single matrix product, and keeps the pairs whose distance is within the
+    # percentageThreshold percentile of all the distances. Points too close to the image boundary have no descriptor
+    # and are never matched. With dense=True the descriptors are looked up in my_local_descriptor_field, which costs
+    # the same for any number of points.
     num_points1 = len(points1)
     num_points2 = len(points2)
 
-    # Compute the Euclidean distances between local descriptors
-    distances = np.zeros((num_points1, num_points2))
-    for i in range(num_points1):
-        descriptor1 = my_local_descriptor(img1, [points1[i][1], points1[i][0]], 5, 20, 0.5, 8)
-        if not descriptor1:
-            continue  # Skip if descriptor1 is empty
-        for j in range(num_points2):
-            descriptor2 = my_local_descriptor(img2, [points2[j][1], points2[j][0]], 5, 20, 0.5, 8)
-            if not descriptor2:
-                continue  # Skip if descriptor2 is empty
-            distance = np.linalg.norm(np.array(descriptor1) - np.array(descriptor2))
-            distances[i, j] = distance
+    descriptors1, valid1 = get_descriptors(img1, points1, 5, 20, 0.5, 8, dense)
+    descriptors2, valid2 = get_descriptors(img2, points2, 5, 20, 0.5, 8, dense)
+
+    if not np.any(valid1) or not np.any(valid2):
+        return []
+
+    # Compute the Euclidean distances between local descriptors: |d1 - d2|^2 = |d1|^2 + |d2|^2 - 2 d1.d2
+    squared_norms1 = np.sum(descriptors1 ** 2, axis=1)
+    squared_norms2 = np.sum(descriptors2 ** 2, axis=1)
+    squared_distances = squared_norms1[:, np.newaxis] + squared_norms2[np.newaxis, :] - \
+        2 * descriptors1 @ descriptors2.T
+    distances = np.sqrt(np.maximum(squared_distances, 0))
 
     # Compute the threshold to select a percentage of point pairs
-    threshold = np.percentile(distances, percentageThreshold)
+    valid = valid1[:, np.newaxis] & valid2[np.newaxis, :]
+    threshold = np.percentile(distances[valid], percentageThreshold)
 
     # Find the matched point pairs based on the threshold
-    matching_points = []
-    for i in range(num_points1):
-        for j in range(num_points2):
-            if distances[i, j] <= threshold:
-                matching_points.append((points1[i], points2[j]))
+    rows, cols = np.nonzero(valid & (distances <= threshold))
+    matching_points = [(points1[i], points2[j]) for i, j in zip(rows, cols)]
+    instrumentation.count("candidate_matches", len(matching_points))
 
     return matching_points
+
+
+def descriptor_matching_ratio(points1, points2, img1, img2, ratio=0.8, mutual=False, dense=False):
+    # Matches every point of img1 to its nearest neighbour among the points of img2 in descriptor space, found with a
+    # KD-tree over the descriptors of img2, and keeps the match only if it is clearly closer than the second nearest
+    # neighbour (Lowe's ratio test). With mutual=True the point of img1 must also be the nearest neighbour of its
+    # match. Unlike descriptor_matching, no distance matrix is built, so the memory is linear in the number of points,
+    # and each point of img1 has at most one match.
+    # - points1, points2: arrays of (row, column) points of img1 and img2
+    # - img1, img2: the grayscale images
+    # - ratio: the maximum ratio between the distances of the nearest and the second nearest neighbour
+    # - mutual: if True only the matches that are nearest neighbours in both directions are kept
+    # - dense: if True the descriptors are looked up in my_local_descriptor_field, see get_descriptors
+    # - matching_points: list of the matched (point of img1, point of img2) pairs
+
+    descriptors1, valid1 = get_descriptors(img1, points1, 5, 20, 0.5, 8, dense)
+    descriptors2, valid2 = get_descriptors(img2, points2, 5, 20, 0.5, 8, dense)
+
+    indices1, indices2 = match_descriptors_ratio(descriptors1, valid1, descriptors2, valid2, ratio, mutual)
+    matching_points = [(points1[i], points2[j]) for i, j in zip(indices1, indices2)]
+
+    return matching_points
+
+
+@instrumentation.timed("matching")
+def match_descriptors_ratio(descriptors1, valid1, descriptors2, valid2, ratio=0.8, mutual=False):
+    # The matching of descriptor_matching_ratio on descriptors that are already computed, as returned by
+    # get_descriptors.
+    # - descriptors1, descriptors2: the descriptors of the points of img1 and img2
+    # - valid1, valid2: boolean arrays that are True for the points that have a descriptor
+    # - ratio, mutual: the parameters of descriptor_matching_ratio
+    # - indices1, indices2: the indices of the matched points of img1 and img2
+
+    indices1 = np.nonzero(valid1)[0]
+    indices2 = np.nonzero(valid2)[0]
+
+    if len(indices1) == 0 or len(indices2) < 2:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    # Find the two nearest neighbours of every point of img1 and apply the ratio test
+    distances, neighbours = cKDTree(descriptors2[indices2]).query(descriptors1[indices1], k=2)
+    keep = np.nonzero(distances[:, 0] < ratio * distances[:, 1])[0]
+    neighbours = neighbours[keep, 0]
+
+    # Keep the matches whose point of img1 is also the nearest neighbour of their point of img2
+    if mutual:
+        _, back = cKDTree(descriptors1[indices1]).query(descriptors2[indices2[neighbours]], k=1)
+        consistent = back == keep
+        keep = keep[consistent]
+        neighbours = neighbours[consistent]
+
+    instrumentation.count("candidate_matches", len(keep))
+
+    return indices1[keep], indices2[neighbours]
+
+
+@instrumentation.timed("descriptors")
+def get_descriptors(img, points, rhom, rhoM, rhostep, N, dense=False):
+    # Computes my_local_descriptor for every (row, column) point and stacks the descriptors in a matrix.
+    # - img: the grayscale image
+    # - points: array of (row, column) points
+    # - rhom, rhoM, rhostep, N: the parameters of my_local_descriptor
+    # - dense: if True the descriptors are looked up in my_local_descriptor_field instead of computed point by point
+    # - descriptors: (number of points, number of circles) matrix with the descriptor of each point in each row; the
+    # rows of the points that are too close to the boundary are zero
+    # - valid: boolean array that is True for the points that have a descriptor
+
+    if dense:
+        field = my_local_descriptor_field(img, rhom, rhoM, rhostep, N)
+        xy = np.asarray(points, dtype=int).reshape(-1, 2)[:, ::-1]
+        descriptors, valid = my_local_descriptor_dense(field, xy, rhoM)
+        return descriptors.astype(np.float64), valid
+
+    num_circles = len(np.arange(rhom, rhoM, rhostep))
+    descriptors = np.zeros((len(points), num_circles))
+    valid = np.zeros(len(points), dtype=bool)
+
+    for i, point in enumerate(points):
+        descriptor = my_local_descriptor(img, [point[1], point[0]], rhom, rhoM, rhostep, N)
+        if descriptor:
+            descriptors[i] = descriptor
+            valid[i] = True
+
+    return descriptors, valid
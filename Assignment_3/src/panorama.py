@@ -0,0 +1,243 @@
+from harrisDetector import *
+from matchDescriptor import *
+from ransac import *
+import hashlib
+import instrumentation
+
+
+def my_panorama(images, Rthres=0.15, r=20, N=10000, ratio=0.8, min_inliers=4, reference=None, cache=None):
+    # Stitches an ordered list of overlapping images into one panorama. The corners and the descriptors of every image
+    # are computed once, each image is matched only with the next one, and the transforms found by my_RANSAC are
+    # chained so that every image is moved into the frame of the reference image. All the images are then warped into
+    # a single canvas, so the cost grows linearly with the number of images.
+    # - images: list of the images, each one overlapping with the next
+    # - Rthres: the threshold of detect_harris_features
+    # - r, N: the parameters of my_RANSAC
+    # - ratio: the ratio of descriptor_matching_ratio
+    # - min_inliers: the minimum number of inliers of the transform between two neighbouring images
+    # - reference: the index of the image whose frame is kept, the middle image if it is None
+    # - cache: dictionary that keeps the features of the images between calls, see get_image_features
+    # - panorama: the stitched image
+    # - transforms: the transform H of every image to the frame of the reference image
+
+    if reference is None:
+        reference = len(images) // 2
+
+    features = [get_image_features(img, Rthres, cache) for img in images]
+    transforms = get_panorama_transforms(features, reference, r, N, ratio, min_inliers)
+    panorama = composite_panorama(images, transforms, reference)
+
+    return panorama, transforms
+
+
+def get_image_features(img, Rthres, cache=None):
+    # Computes the Harris corners of an image and their descriptors. If a cache dictionary is given, the features are
+    # kept in it, keyed by the hash of the image bytes and the threshold, and are computed only the first time.
+    # - img: the image
+    # - Rthres: the threshold of detect_harris_features
+    # - cache: the dictionary of the cached features, the features are not cached if it is None
+    # - features: dictionary with the (row, column) 'corners', their 'descriptors' and the 'valid' array of
+    # get_descriptors
+
+    if cache is not None:
+        h = hashlib.sha256()
+        h.update(np.ascontiguousarray(img).tobytes())
+        h.update(repr((img.shape, str(img.dtype), Rthres)).encode())
+        key = h.hexdigest()
+
+        if key in cache:
+            instrumentation.count("feature_cache_hits")
+            return cache[key]
+
+    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
+
+    corners = detect_harris_features(img_gray, Rthres)
+    descriptors, valid = get_descriptors(img_gray, corners, 5, 20, 0.5, 8, dense=True)
+    features = {'corners': corners, 'descriptors': descriptors, 'valid': valid}
+
+    if cache is not None:
+        cache[key] = features
+
+    return features
+
+
+def get_panorama_transforms(features, reference, r=20, N=10000, ratio=0.8, min_inliers=4):
+    # Finds the transform of every image to the frame of the reference image, by matching each image with the next one
+    # and chaining the transforms of the neighbouring images.
+    # - features: the features of every image, as returned by get_image_features
+    # - reference: the index of the reference image
+    # - r, N, ratio, min_inliers: the parameters of my_panorama
+    # - transforms: the transform H of every image to the frame of the reference image
+
+    # Transform of every image to the next one
+    steps = []
+    for i in range(len(features) - 1):
+        features1, features2 = features[i], features[i + 1]
+        indices1, indices2 = match_descriptors_ratio(features1['descriptors'], features1['valid'],
+                                                     features2['descriptors'], features2['valid'], ratio)
+        matching_points = [(features1['corners'][j], features2['corners'][k]) for j, k in zip(indices1, indices2)]
+
+        H, inlier_matching_points, _ = my_RANSAC(matching_points, r, N)
+        if len(inlier_matching_points) < min_inliers:
+            raise ValueError("Could not match image " + str(i) + " with image " + str(i + 1))
+        steps.append(H)
+
+    # Chain the transforms towards the reference image
+    transforms = [None] * len(features)
+    transforms[reference] = {'theta': 0, 'd': np.zeros(2)}
+    for i in range(reference - 1, -1, -1):
+        transforms[i] = compose_h(steps[i], transforms[i + 1])
+    for i in range(reference + 1, len(features)):
+        transforms[i] = compose_h(invert_h(steps[i - 1]), transforms[i - 1])
+
+    return transforms
+
+
+@instrumentation.timed("composite")
+def composite_panorama(images, transforms, reference):
+    # Warps all the images into one canvas, the bounding box of all of them in the frame of the reference image. The
+    # images are drawn from the farthest from the reference to the reference itself, so the images closer to the
+    # reference end on top, like img2 in my_stitch.
+    # - images: the list of the images
+    # - transforms: the transform H of every image to the frame of the reference image
+    # - reference: the index of the reference image
+    # - panorama: the stitched image
+
+    # Find the bounding box of all the moved images
+    corners = []
+    for img, H in zip(images, transforms):
+        M, N = img.shape[:2]
+        image_corners = np.array([[0, 0], [0, N - 1], [M - 1, 0], [M - 1, N - 1]], dtype=np.float64)
+        corners.append(transform_points_exact(image_corners, H))
+    corners = np.vstack(corners)
+
+    top_left = np.floor(np.min(corners, axis=0)).astype(int)
+    bottom_right = np.ceil(np.max(corners, axis=0)).astype(int)
+    height, width = bottom_right - top_left + 1
+
+    panorama = np.zeros((height, width) + images[reference].shape[2:], dtype=images[reference].dtype)
+    instrumentation.count("canvas_bytes", panorama.nbytes)
+
+    order = sorted(range(len(images)), key=lambda i: -abs(i - reference))
+    for i in order:
+        theta = transforms[i]['theta']
+        d = np.asarray(transforms[i]['d'], dtype=np.float64) - top_left
+
+        # Affine matrix of cv2, which works with (x, y) = (column, row) points
+        A = np.array([[np.cos(theta), np.sin(theta), d[1]],
+                      [-np.sin(theta), np.cos(theta), d[0]]])
+        cv2.warpAffine(images[i], A, (width, height), dst=panorama, flags=cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_TRANSPARENT)
+
+    return panorama
+
+
+def transform_points_exact(points, H):
+    # Works like transform_points, without rounding the moved points to integers.
+    # - points: array of (row, column) points
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the transform
+    # - transformed_points: the moved points
+
+    theta = H['theta']
+    R = np.array([[np.cos(theta), -np.sin(theta)],
+                  [np.sin(theta), np.cos(theta)]])
+
+    transformed_points = np.dot(R, np.asarray(points, dtype=np.float64).T).T + H['d']
+
+    return transformed_points
+
+
+def my_sequence_panorama(frames, Rthres=0.15, r=5, N=1000, min_coverage=0.5, min_inliers=8):
+    # Stitches the frames of a video or a burst capture into one panorama in the frame of the first one, with the
+    # transforms of track_frames.
+    # - frames: iterable of the frames, in the order they were captured
+    # - Rthres, r, N, min_coverage, min_inliers: the parameters of track_frames
+    # - panorama: the stitched image
+    # - transforms: the transform H of every frame to the first frame
+
+    frames = list(frames)
+    transforms = list(track_frames(frames, Rthres, r, N, min_coverage, min_inliers))
+    panorama = composite_panorama(frames, transforms, 0)
+
+    return panorama, transforms
+
+
+def track_frames(frames, Rthres=0.15, r=5, N=1000, min_coverage=0.5, min_inliers=8):
+    # Finds the transform of every frame of a sequence to the first frame and yields it as soon as the frame is
+    # processed. Instead of detecting and matching the corners of every frame, the corners of the previous frame are
+    # followed into the next one with pyramidal Lucas-Kanade optical flow, and the tracked pairs go straight to
+    # my_RANSAC. The corners are detected again only when less than min_coverage of them is still tracked, and the
+    # frames are matched with their descriptors only when the tracked pairs do not give a transform with min_inliers,
+    # or when the previous frame has no corners to follow.
+    # - frames: iterable of the frames, in the order they were captured
+    # - Rthres: the threshold of detect_harris_features
+    # - r, N: the parameters of my_RANSAC
+    # - min_coverage: the fraction of the detected corners under which the corners are detected again
+    # - min_inliers: the minimum number of inliers of the transform between two frames
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the transform of the frame to the
+    # first frame
+
+    previous_gray = None
+    previous_features = None
+
+    for index, frame in enumerate(frames):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if len(frame.shape) == 3 else frame
+        features = None
+
+        if index == 0:
+            H = {'theta': 0, 'd': np.zeros(2)}
+            corners = np.empty((0, 2))
+        else:
+            # A blank previous frame has no corners to follow, so it is matched with its descriptors straight away
+            inlier_matching_points = []
+            if len(corners) > 0:
+                # Follow the corners of the previous frame, as (x, y) = (column, row) points, and back again; the
+                # corners that do not return to where they started are not tracked reliably
+                points = np.ascontiguousarray(corners[:, ::-1], dtype=np.float32).reshape(-1, 1, 2)
+                tracked, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray, gray, points, None, winSize=(21, 21),
+                                                             maxLevel=3)
+                back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, previous_gray, tracked, None, winSize=(21, 21),
+                                                               maxLevel=3)
+                returned = np.linalg.norm((back - points).reshape(-1, 2), axis=1) < 1
+
+                tracked = tracked.reshape(-1, 2)[:, ::-1]
+                height, width = gray.shape
+                found = (status.ravel() == 1) & (back_status.ravel() == 1) & returned & np.all(tracked >= 0, axis=1) & \
+                    (tracked[:, 0] < height) & (tracked[:, 1] < width)
+
+                matching_points = list(zip(tracked[found], corners[found]))
+                H_step, inlier_matching_points, _ = my_RANSAC(matching_points, r, N)
+
+            if len(inlier_matching_points) >= min_inliers:
+                corners = np.array([pair[0] for pair in inlier_matching_points])
+            else:
+                # Tracking is lost: match the descriptors of both frames instead
+                instrumentation.count("tracking_fallbacks")
+                if previous_features is None:
+                    previous_features = get_image_features(previous_gray, Rthres)
+                features = get_image_features(gray, Rthres)
+                indices1, indices2 = match_descriptors_ratio(features['descriptors'], features['valid'],
+                                                             previous_features['descriptors'],
+                                                             previous_features['valid'])
+                matching_points = [(features['corners'][i], previous_features['corners'][j])
+                                   for i, j in zip(indices1, indices2)]
+                H_step, inlier_matching_points, _ = my_RANSAC(matching_points, r, N)
+                if len(inlier_matching_points) < min_inliers:
+                    raise ValueError("Could not match frame " + str(index) + " with the previous frame")
+
+                corners = features['corners']
+                num_detected = len(corners)
+
+            H = compose_h(H_step, H)
+
+        # Detect the corners again when too few of them are left, or when none were found the last time
+        if index == 0 or num_detected == 0 or len(corners) < min_coverage * num_detected:
+            corners = detect_harris_features(gray, Rthres)
+            num_detected = len(corners)
+            instrumentation.count("redetections")
+
+        previous_gray = gray
+        previous_features = features
+        instrumentation.count("frames")
+
+        yield H
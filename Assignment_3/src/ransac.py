@@ -1,5 +1,5 @@
 import numpy as np
-import random
+import instrumentation
 
 
 def calculate_h(pair1, pair2):
@@ -25,6 +25,29 @@ def calculate_h(pair1, pair2):
     return H
 
 
+def calculate_h_least_squares(points1, points2):
+    # Finds the rotation and translation that move points1 closest to points2 in the least squares sense. The rotation
+    # is the angle that maximizes the correlation of the centered points, the translation then moves the centroids
+    # onto each other.
+    # - points1, points2: arrays of the matched (row, column) points of img1 and img2
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the transform
+
+    centroid1 = np.mean(points1, axis=0)
+    centroid2 = np.mean(points2, axis=0)
+    centered1 = points1 - centroid1
+    centered2 = points2 - centroid2
+
+    theta = np.arctan2(np.sum(centered1[:, 0] * centered2[:, 1] - centered1[:, 1] * centered2[:, 0]),
+                       np.sum(centered1 * centered2))
+
+    R = np.array([[np.cos(theta), -np.sin(theta)],
+                  [np.sin(theta), np.cos(theta)]])
+
+    H = {'theta': theta, 'd': centroid2 - np.dot(R, centroid1)}
+
+    return H
+
+
 def transform_points(points, H):
     theta = H['theta']  # in rad
     d = H['d']
@@ -41,37 +64,149 @@ def transform_points(points, H):
     return transformed_points.astype(int)
 
 
-def my_RANSAC(matching_points, r, N):
+def compose_h(H1, H2):
+    # Combines two transforms into one that applies H1 and then H2: R2 (R1 p + d1) + d2.
+    # - H1, H2: dictionaries with the rotation angle 'theta' (rad) and the translation 'd' of the transforms
+    # - H: dictionary with the rotation angle and the translation of the combined transform
+
+    theta2 = H2['theta']
+    R2 = np.array([[np.cos(theta2), -np.sin(theta2)],
+                   [np.sin(theta2), np.cos(theta2)]])
+
+    H = {'theta': H1['theta'] + theta2, 'd': np.dot(R2, H1['d']) + np.asarray(H2['d'], dtype=np.float64)}
+
+    return H
+
+
+def invert_h(H):
+    # Finds the transform that undoes H: p = R^T (p' - d).
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the transform
+    # - H_inv: dictionary with the rotation angle and the translation of the inverse transform
+
+    theta = H['theta']
+    R = np.array([[np.cos(theta), -np.sin(theta)],
+                  [np.sin(theta), np.cos(theta)]])
+
+    H_inv = {'theta': -theta, 'd': -np.dot(R.T, H['d'])}
+
+    return H_inv
+
+
+@instrumentation.timed("ransac")
+def my_RANSAC(matching_points, r, N, confidence=0.99, batch_size=256, seed=None):
+    # Finds the transform between the matched points with RANSAC. The matches are converted to arrays once, and the
+    # hypotheses, each computed with calculate_h from two random matches, are scored in batches: every hypothesis of a
+    # batch moves all the points of img1 at once and counts its inliers, the matches that land closer than r to their
+    # point in img2. The search stops as soon as the number of iterations is enough to have drawn, with the given
+    # confidence, at least one sample of two inliers of the best hypothesis, or after N iterations. Two close matches
+    # give an imprecise angle, so the best hypothesis is finally fitted again to all of its inliers with
+    # calculate_h_least_squares, and the refined transform is kept if it has at least as many inliers.
+    # - matching_points: list of the matched (point of img1, point of img2) pairs of (row, column) points
+    # - r: the distance under which a match is an inlier of the final transform
+    # - N: the maximum number of iterations
+    # - confidence: the probability of drawing at least one sample of two inliers before stopping; with 1 the search
+    # does not stop early
+    # - batch_size: the number of hypotheses scored together
+    # - seed: the seed of the random number generator
+    # - H: dictionary with the rotation angle 'theta' (rad) and the translation 'd' of the best transform
+    # - inlier_matching_points, outlier_matching_points: the matches that are and are not inliers of H
+
     H = {'theta': 0, 'd': [0, 0]}
-    inlier_matching_points = []
-    outlier_matching_points = []
-    best_distance = []
+    num_matches = len(matching_points)
+
+    if num_matches < 2:
+        return H, [], list(matching_points)
 
+    points1 = np.array([pair[0] for pair in matching_points], dtype=np.float64)
+    points2 = np.array([pair[1] for pair in matching_points], dtype=np.float64)
+
+    # Keep the batches within about 2^22 distances for large numbers of matches
+    batch_size = max(1, min(batch_size, (1 << 22) // num_matches))
+
+    rng = np.random.default_rng(seed)
     score = 0
+    best_sample = None
+    iterations = 0
+    required_iterations = N
+
+    while iterations < required_iterations:
+        size = min(batch_size, required_iterations - iterations)
+
+        # Draw two different matches for every hypothesis
+        first = rng.integers(num_matches, size=size)
+        second = rng.integers(num_matches - 1, size=size)
+        second += second >= first
+
+        theta, d = calculate_h_batch(points1[first], points2[first], points1[second], points2[second])
+
+        # Move the points of img1 with every hypothesis and truncate them like transform_points
+        cos_theta = np.cos(theta)[:, np.newaxis]
+        sin_theta = np.sin(theta)[:, np.newaxis]
+        rows = np.trunc(cos_theta * points1[:, 0] - sin_theta * points1[:, 1] + d[:, 0:1])
+        cols = np.trunc(sin_theta * points1[:, 0] + cos_theta * points1[:, 1] + d[:, 1:2])
 
-    for i in range(N):
-        pair1, pair2 = random.sample(matching_points, 2)
+        squared_distances = (rows - points2[:, 0]) ** 2 + (cols - points2[:, 1]) ** 2
+        counts = np.count_nonzero(squared_distances < r ** 2, axis=1)
 
-        H_temp = calculate_h(pair1, pair2)
+        best = np.argmax(counts)
+        if counts[best] > score:
+            score = counts[best]
+            best_sample = (first[best], second[best])
 
-        points1 = [pair[0] for pair in matching_points]
-        points2 = [pair[1] for pair in matching_points]
-        transformed_points1 = transform_points(points1, H_temp)
-        transformed_points2 = transform_points(points2, {'theta': 0, 'd': [0, 0]})
+            # Update the number of iterations needed for the confidence
+            inlier_ratio = score / num_matches
+            if inlier_ratio >= 1:
+                required_iterations = iterations + size
+            elif confidence < 1:
+                bound = np.log(1 - confidence) / np.log(1 - inlier_ratio ** 2)
+                if np.isfinite(bound):
+                    required_iterations = min(N, int(np.ceil(bound)))
 
-        distance = np.linalg.norm(transformed_points2 - transformed_points1, axis=1)
-        count = np.count_nonzero(distance < 80)
+        iterations += size
 
-        if count > score:
-            score = count
-            best_distance = distance
-            H['theta'] = H_temp['theta']
-            H['d'] = H_temp['d']
+    instrumentation.count("ransac_iterations", iterations)
 
-    for i in range(len(best_distance)):
-        if best_distance[i] < r:
-            inlier_matching_points.append(matching_points[i])
-        else:
-            outlier_matching_points.append(matching_points[i])
+    if best_sample is None:
+        return H, [], list(matching_points)
+
+    first, second = best_sample
+    H_best = calculate_h(matching_points[first], matching_points[second])
+    distance = np.linalg.norm(points2.astype(int) - transform_points(points1, H_best), axis=1)
+
+    inliers = distance < r
+    if np.count_nonzero(inliers) > 2:
+        H_refined = calculate_h_least_squares(points1[inliers], points2[inliers])
+        refined_distance = np.linalg.norm(points2.astype(int) - transform_points(points1, H_refined), axis=1)
+        if np.count_nonzero(refined_distance < r) >= np.count_nonzero(inliers):
+            H_best = H_refined
+            distance = refined_distance
+
+    H['theta'] = H_best['theta']
+    H['d'] = H_best['d']
+
+    inlier_matching_points = [matching_points[i] for i in np.nonzero(distance < r)[0]]
+    outlier_matching_points = [matching_points[i] for i in np.nonzero(distance >= r)[0]]
 
     return H, inlier_matching_points, outlier_matching_points
+
+
+def calculate_h_batch(point1_1, point1_2, point2_1, point2_2):
+    # Works like calculate_h for many pairs of matches at once.
+    # - point1_1, point1_2: (number of hypotheses, 2) arrays with the points of the first match in img1 and img2
+    # - point2_1, point2_2: (number of hypotheses, 2) arrays with the points of the second match in img1 and img2
+    # - theta: the rotation angle (rad) of every hypothesis
+    # - d: (number of hypotheses, 2) array with the translation of every hypothesis
+
+    # Calculate vectors from the points
+    vector1 = point2_1 - point1_1
+    vector2 = point2_2 - point1_2
+
+    # Calculate the angle theta
+    theta = np.arctan2(vector2[:, 1], vector2[:, 0]) - np.arctan2(vector1[:, 1], vector1[:, 0])
+
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+    d = np.column_stack((point1_2[:, 0] - (cos_theta * point1_1[:, 0] - sin_theta * point1_1[:, 1]),
+                         point1_2[:, 1] - (sin_theta * point1_1[:, 0] + cos_theta * point1_1[:, 1])))
+
+    return theta, d